@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Shared message corpus for the benchmark scripts
+Real messages from chat_histories/ (English and Arabic), padded with typical
+group-chat lines so every benchmark has enough distinct inputs
+"""
+
+import json
+import os
+import random
+
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_histories")
+
+SAMPLE_MESSAGES = [
+    "hi",
+    "hey bestie how are you",
+    "anyone playing elden ring tonight?",
+    "this patch is so broken lol",
+    "tell me a joke",
+    "calculate 12*7+3",
+    "generate password 12",
+    "what's the weather like outside",
+    "bg3 or witcher 3, which one should i play first",
+    "haha that's so funny",
+    "i'm hungry what should i eat for dinner",
+    "the raid boss bugged out again, devs pls fix",
+    "flip coin for who carries",
+    "roll dice",
+    "give me a tip for valorant aim",
+    "what color is today",
+    "astra nova lore is actually insane",
+    "that doesn't even exist bro",
+    "wyd",
+    "help",
+    "مسا الورد",
+    "شلونكم يا شباب",
+    "يلا نلعب؟",
+    "والله اللعبة حلوة كثير",
+    "هههههه",
+    "حبيبي شو الأخبار",
+    "yalla habibi let's wreck this lobby",
+    "wallah this update is fire",
+    "I love gaming so much!",
+    "This is really frustrating...",
+    "OMG this patch is AMAZING!! 🔥",
+]
+
+
+def load_history_corpus(directory=HISTORY_DIR, roles=("user", "assistant")):
+    """Every message stored in chat_histories/, both .json and .jsonl files"""
+    messages = []
+    if not os.path.isdir(directory):
+        return messages
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        try:
+            if file.endswith(".json"):
+                with open(path, "r", encoding="utf-8") as f:
+                    records = json.load(f)
+            elif file.endswith(".jsonl"):
+                with open(path, "r", encoding="utf-8") as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+            else:
+                continue
+        except (OSError, ValueError):
+            continue
+        messages.extend(r["content"] for r in records if r.get("role") in roles and r.get("content"))
+    return messages
+
+
+def build_corpus(size=1000, seed=42):
+    """`size` messages: the real history first, then sample lines in random order"""
+    rng = random.Random(seed)
+    corpus = load_history_corpus() + SAMPLE_MESSAGES
+    while len(corpus) < size:
+        corpus.append(rng.choice(SAMPLE_MESSAGES))
+    return corpus[:size]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the chat history stores
+Seeds the same synthetic chats into the JSONL journals and the SQLite database
+and compares seeding, random loads, appends, listing chats and retention
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import main
+
+
+def make_messages(chat_index, count):
+    return [{
+        "role": "user" if i % 2 == 0 else "assistant",
+        "content": f"chat {chat_index} message {i} yalla let's wreck this patch",
+        "timestamp": f"2025-08-09T08:{i // 60:02d}:{i % 60:02d}.000000"
+    } for i in range(count)]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def timed_ops(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def list_chats(backend):
+    if backend == "sqlite":
+        with main._history_db_lock:
+            return [row[0] for row in main.get_history_db().execute("SELECT DISTINCT chat_id FROM messages")]
+    return [os.path.splitext(f)[0] for f in os.listdir(main.HISTORY_DIR)]
+
+
+def run_backend(backend, workdir, chats, ops, seed):
+    main.HISTORY_BACKEND = backend
+    main.HISTORY_DIR = os.path.join(workdir, f"{backend}_histories")
+    main.HISTORY_DB_PATH = os.path.join(workdir, f"{backend}.db")
+    main._journal_line_counts.clear()
+    main.close_history_db()
+    rng = random.Random(seed)
+    results = {}
+
+    start = time.perf_counter()
+    for chat in range(chats):
+        main._store_write_history(str(chat), make_messages(chat, main.CONTEXT_MSG_LIMIT))
+    results["seed_s"] = time.perf_counter() - start
+
+    # Fresh process state so loads pay for opening the chat like after a restart
+    main._journal_line_counts.clear()
+    load_args = [(str(rng.randrange(chats)),) for _ in range(ops)]
+    results["load"] = timed_ops(main._store_read_history, load_args)
+
+    append_args = [(str(rng.randrange(chats)), make_messages(0, 2)) for _ in range(ops)]
+    results["append"] = timed_ops(main._store_append_history, append_args)
+
+    start = time.perf_counter()
+    count = len(list_chats(backend))
+    results["list_s"] = time.perf_counter() - start
+    assert count == chats, f"{backend}: expected {chats} chats, found {count}"
+
+    start = time.perf_counter()
+    if backend == "sqlite":
+        main.prune_sqlite_history()
+    else:
+        for chat in range(chats):
+            main.compact_chat_journal(str(chat))
+    results["retention_s"] = time.perf_counter() - start
+    main.close_history_db()
+    return results
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10000, help="number of chats to seed")
+    parser.add_argument("--ops", type=int, default=5000, help="random loads and appends per backend")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="history_bench_")
+    try:
+        print(f"📊 History store benchmark: {args.chats} chats, {args.ops} ops, "
+              f"{main.CONTEXT_MSG_LIMIT} messages per chat")
+        print(f"{'backend':<8} {'seed s':>8} {'load p50 ms':>12} {'load p95 ms':>12} "
+              f"{'append p50 ms':>14} {'append p95 ms':>14} {'list s':>8} {'retention s':>12}")
+        for backend in ("jsonl", "sqlite"):
+            r = run_backend(backend, workdir, args.chats, args.ops, args.seed)
+            print(f"{backend:<8} {r['seed_s']:>8.2f} "
+                  f"{statistics.median(r['load']) * 1000:>12.3f} {percentile(r['load'], 95) * 1000:>12.3f} "
+                  f"{statistics.median(r['append']) * 1000:>14.3f} {percentile(r['append'], 95) * 1000:>14.3f} "
+                  f"{r['list_s']:>8.3f} {r['retention_s']:>12.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the per-message CPU path
+Times make_more_human, sentiment, ChatContext, the similarity lookup, the
+history cache and full prompt assembly in get_human_reply (network stubbed)
+on messages from chat_histories/, Arabic included. --save writes a JSON
+baseline, --compare diffs a run against one and exits 1 on a regression.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_corpus import build_corpus
+import main
+
+CANNED_COMPLETION = {"choices": [{"message": {"content": "omg yes bestie. that boss is so unfair. we should run it again tonight"}}]}
+
+
+def time_calls(fn, inputs, rounds):
+    """Per-call seconds for each round over all inputs"""
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for args in inputs:
+            fn(*args)
+        samples.append((time.perf_counter() - start) / len(inputs))
+    return samples
+
+
+def bench_make_more_human(corpus, rounds):
+    random.seed(0)
+    inputs = [(text, sentiment, mood) for text, sentiment, mood in zip(
+        corpus, ["positive", "neutral", "negative"] * len(corpus), ["morning", "evening", "night"] * len(corpus))]
+    return time_calls(main.make_more_human, inputs, rounds)
+
+
+def bench_sentiment(corpus, rounds):
+    """Cold: every round starts with an empty cache, like distinct new messages"""
+    inputs = [(text,) for text in corpus]
+    samples = []
+    for _ in range(rounds):
+        for engine in main.SENTIMENT_ENGINES.values():
+            engine.cache_clear()
+        samples += time_calls(main.get_sentiment_analysis, inputs, 1)
+    return samples
+
+
+def bench_analyze_message(corpus, rounds):
+    context = main.ChatContext()
+    inputs = [(1000 + i % 20, f"user{i % 20}", text) for i, text in enumerate(corpus)]
+    return time_calls(context.analyze_message, inputs, rounds)
+
+
+def bench_context_summary(corpus, rounds):
+    context = main.ChatContext()
+    for i, text in enumerate(corpus[:50]):
+        context.analyze_message(1000 + i % 5, f"user{i % 5}", text)
+    return time_calls(context.get_context_summary, [()] * 1000, rounds)
+
+
+def bench_similarity(corpus, rounds):
+    index = main.SimilarityIndex()
+    for text in corpus:
+        index.add(text)
+    main._similarity_indexes["bench_similar"] = index
+    inputs = [("bench_similar", text) for text in corpus[::7][:300]]
+    return time_calls(main.find_similar_user_message, inputs, rounds)
+
+
+class RunningFlusher:
+    """Stands in for the flusher task outside an event loop, so appends stay pending"""
+    def done(self):
+        return False
+
+
+def bench_history(corpus, rounds):
+    """One load plus one append per call, through the cache with the flusher's batching"""
+    main._history_flusher_task = RunningFlusher()
+    chats = [f"bench_history_{i}" for i in range(50)]
+    for chat_id in chats:
+        main.add_message_to_history(chat_id, "user", "seed")
+
+    def load_and_append(chat_id, text):
+        main.load_chat_history(chat_id)
+        main.add_message_to_history(chat_id, "user", text)
+
+    inputs = [(chats[i % len(chats)], text) for i, text in enumerate(corpus)]
+    try:
+        return time_calls(load_and_append, inputs, rounds)
+    finally:
+        main._history_flusher_task = None
+        main._history_pending.clear()
+
+
+def bench_prompt_assembly(corpus, rounds):
+    """get_human_reply end to end with the completion call answered instantly"""
+    async def instant_completion(payload):
+        return CANNED_COMPLETION
+
+    main.OPENAI_STREAM = False
+    main.post_chat_completion = instant_completion
+    inputs = [(text, main.SYLVIA_PERSONA, f"bench_prompt_{i % 10}", 1000 + i % 20, f"user{i % 20}")
+              for i, text in enumerate(corpus[:300])]
+
+    async def run():
+        main._history_flusher_task = asyncio.get_running_loop().create_future()
+        samples = []
+        try:
+            for _ in range(rounds):
+                start = time.perf_counter()
+                for args in inputs:
+                    await main.get_human_reply(*args)
+                samples.append((time.perf_counter() - start) / len(inputs))
+        finally:
+            main._history_flusher_task = None
+            main._history_pending.clear()
+        return samples
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(run())
+
+
+BENCHMARKS = {
+    "make_more_human": bench_make_more_human,
+    "get_sentiment_analysis": bench_sentiment,
+    "ChatContext.analyze_message": bench_analyze_message,
+    "ChatContext.get_context_summary": bench_context_summary,
+    "find_similar_user_message": bench_similarity,
+    "load_chat_history+add_message_to_history": bench_history,
+    "get_human_reply prompt assembly": bench_prompt_assembly,
+}
+
+
+def summarize(samples):
+    return {
+        "median_us": statistics.median(samples) * 1e6,
+        "min_us": min(samples) * 1e6,
+        "stdev_us": (statistics.stdev(samples) if len(samples) > 1 else 0.0) * 1e6,
+        "rounds": len(samples)
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline, return the names that got slower than threshold"""
+    regressions = []
+    print(f"\n{'benchmark':<42} {'baseline µs':>12} {'now µs':>10} {'change':>8}")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<42} {'-':>12} {result['median_us']:>10.2f} {'new':>8}")
+            continue
+        change = result["median_us"] / before["median_us"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " ⚠️"
+        print(f"{name:<42} {before['median_us']:>12.2f} {result['median_us']:>10.2f} {change:>+8.0%}{flag}")
+    return regressions
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000, help="corpus size")
+    parser.add_argument("--rounds", type=int, default=7, help="timed passes over the corpus per benchmark")
+    parser.add_argument("--only", action="append", help="run only benchmarks whose name contains this")
+    parser.add_argument("--save", metavar="PATH", help="write results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="diff against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    workdir = tempfile.mkdtemp(prefix="hot_path_bench_")
+    main.HISTORY_DIR = os.path.join(workdir, "chat_histories")
+    main.HISTORY_DB_PATH = os.path.join(workdir, "chat_histories.db")
+    results = {}
+    try:
+        print(f"📊 Hot path benchmarks: {len(corpus)} messages, {args.rounds} rounds")
+        print(f"{'benchmark':<42} {'median µs':>10} {'min µs':>10} {'stdev µs':>10}")
+        for name, bench in BENCHMARKS.items():
+            if args.only and not any(part in name for part in args.only):
+                continue
+            results[name] = summarize(bench(corpus, args.rounds))
+            r = results[name]
+            print(f"{name:<42} {r['median_us']:>10.2f} {r['min_us']:>10.2f} {r['stdev_us']:>10.2f}")
+    finally:
+        main.close_history_db()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "messages": len(corpus),
+                "results": results
+            }, f, indent=2)
+        print(f"💾 Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("✅ No regressions")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for message routing
+Compares the compiled intent router against the sequential keyword scans it
+replaced (get_human_reply, ChatContext.analyze_message and the group handler)
+"""
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_corpus import build_corpus
+from main import route_message
+
+LEGACY_CHECKS = [
+    ["joke", "funny", "laugh", "humor"],
+    ["weather", "outside", "sunny", "rainy"],
+    ["game", "play", "playing", "rpg", "strategy"],
+    ["doesn't exist", "not real", "doesn't even exist"],
+    ["quote", "inspire", "motivation"],
+    ["hi", "hello", "hey"],
+    ["how are you", "hru", "what's up", "wyd"],
+    ["lol", "haha", "funny"],
+    ["math", "calculate"],
+    ["password", "pass", "generate password"],
+    ["flip coin", "coin flip", "heads or tails"],
+    ["roll dice", "dice", "random number"],
+    ["food", "eat", "hungry", "dinner", "lunch"],
+    ["tip", "advice", "help me"],
+    ["color", "colour", "today"],
+    ["help", "commands", "what can you do"],
+    ["rpg", "strategy", "fantasy", "astra", "baldur", "elden", "witcher"],
+    # ChatContext.analyze_message
+    ["game", "play", "gaming", "rpg", "strategy"],
+    ["code", "programming", "bug", "debug"],
+    ["food", "eat", "hungry"],
+    ["fallout", "baldur", "bg3", "elden", "witcher", "cyberpunk", "skyrim", "minecraft", "valorant",
+     "league", "astra"],
+    ["excited", "awesome", "amazing", "love", "great"],
+    ["bug", "problem", "issue", "broken", "doesn't work"],
+    ["funny", "lol", "haha", "joke"],
+    # handler
+    ["game", "gaming", "play", "raid", "boss", "level", "patch", "update", "tech", "code", "dev"],
+]
+
+
+def legacy_route(message):
+    """Worst case of the old code path: every any(word in msg_lower ...) scan"""
+    msg_lower = message.lower()
+    return [any(word in msg_lower for word in words) for words in LEGACY_CHECKS]
+
+
+def bench(fn, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in corpus:
+            fn(message)
+    return (time.perf_counter() - start) / (rounds * len(corpus))
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    route_message(corpus[0])  # Warm up the compiled matcher
+    legacy = bench(legacy_route, corpus, args.rounds)
+    routed = bench(route_message, corpus, args.rounds)
+    print(f"📊 Routing cost over {len(corpus)} messages x {args.rounds} rounds")
+    print(f"  keyword scans   {legacy * 1e6:8.2f} µs/message")
+    print(f"  intent router   {routed * 1e6:8.2f} µs/message  ({legacy / routed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Accuracy and latency comparison of the sentiment engines
+Scores a small hand-labelled set for accuracy, then the chat_histories corpus
+for agreement with TextBlob and for cold (uncached) and warm (cached) latency
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_corpus import build_corpus
+import main
+
+LABELLED_MESSAGES = [
+    ("I love gaming so much!", "positive"),
+    ("This is really frustrating...", "negative"),
+    ("Hey, how are you doing?", "neutral"),
+    ("OMG this patch is AMAZING!! 🔥", "positive"),
+    ("this update is trash", "negative"),
+    ("bg3 is goated fr", "positive"),
+    ("the servers are so laggy today ugh", "negative"),
+    ("anyone online?", "neutral"),
+    ("gg ez", "positive"),
+    ("that boss fight was boring", "negative"),
+    ("not bad at all", "positive"),
+    ("this is not good", "negative"),
+    ("what time is the raid", "neutral"),
+    ("lmao that's hilarious 😂", "positive"),
+    ("i hate this stupid bug", "negative"),
+    ("yalla habibi mashallah", "positive"),
+    ("wallah this is mid", "negative"),
+    ("مسا الورد", "positive"),
+    ("تشرفنا فيك يا غالي", "positive"),
+    ("اللعبة حلوة كثير", "positive"),
+    ("هههههههه", "positive"),
+    ("شو الأخبار", "neutral"),
+    ("وين الناس", "neutral"),
+    ("هذا زفت والله", "negative"),
+    ("اللعبة مملة", "negative"),
+    ("انا حزين اليوم", "negative"),
+    ("❤️❤️", "positive"),
+    ("💔", "negative"),
+    ("@RJ20xfc", "neutral"),
+    ("when is the next update", "neutral"),
+]
+
+_ARABIC = re.compile(r"[\u0600-\u06FF]")
+
+
+def label(polarity):
+    if polarity > 0.1:
+        return "positive"
+    if polarity < -0.1:
+        return "negative"
+    return "neutral"
+
+
+def timed(fn, texts):
+    start = time.perf_counter()
+    for text in texts:
+        fn(text)
+    return (time.perf_counter() - start) / len(texts)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    args = parser.parse_args()
+
+    corpus = [main.normalize_sentiment_text(m) for m in build_corpus(args.messages)]
+    labelled = [(main.normalize_sentiment_text(t), expected) for t, expected in LABELLED_MESSAGES]
+    reference = {text: label(main.textblob_polarity.__wrapped__(text)) for text in corpus}
+
+    print(f"📊 Sentiment engines: {len(labelled)} labelled messages, {len(corpus)} corpus messages")
+    print(f"{'engine':<9} {'accuracy':>9} {'agree EN':>9} {'agree AR':>9} {'cold µs':>9} {'warm µs':>9}")
+    for name, engine in main.SENTIMENT_ENGINES.items():
+        uncached = engine.__wrapped__
+        accuracy = sum(label(uncached(t)) == expected for t, expected in labelled) / len(labelled)
+        agree = {"EN": [], "AR": []}
+        for text in corpus:
+            agree["AR" if _ARABIC.search(text) else "EN"].append(label(uncached(text)) == reference[text])
+        cold = timed(uncached, corpus)
+        engine.cache_clear()
+        timed(engine, corpus)
+        warm = timed(engine, corpus)
+        rates = {k: (sum(v) / len(v) if v else float("nan")) for k, v in agree.items()}
+        print(f"{name:<9} {accuracy:>9.0%} {rates['EN']:>9.0%} {rates['AR']:>9.0%} "
+              f"{cold * 1e6:>9.1f} {warm * 1e6:>9.2f}")
+
+
+if __name__ == "__main__":
+    main_bench()
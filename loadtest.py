@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Local load test for the message pipeline
+Feeds synthetic Telegram NewMessage events into the bot's real handler
+(dispatcher, reply decision, get_human_reply, history) while completions come
+from a stub OpenAI server in a separate process with configurable latency and
+error injection. The human-like reply delay is scaled by --time-scale so a run measures
+the bot, not its pretend typing. Needs no Telegram account and no API key.
+"""
+
+import argparse
+import asyncio
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_corpus import build_corpus
+import main
+
+STUB_REPLY = "omg yes bestie. that patch is actually wild, the new map is so fun. we should queue later fr"
+BOT_ID = 424242
+BOT_USERNAME = "sylvia"
+
+
+# =============== STUB OPENAI SERVER ===============
+
+class StubOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.5
+    token_interval = 0.01
+    error_rate = 0.0
+    rng = random.Random()
+
+    def _send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._send_json(200, {"data": []})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        roll = self.rng.random()
+        if roll < self.error_rate / 2:
+            return self._send_json(429, {"error": "rate limited"}, [("Retry-After", "1")])
+        if roll < self.error_rate:
+            return self._send_json(503, {"error": "overloaded"})
+        if not request.get("stream"):
+            return self._send_json(200, {"choices": [{"message": {"content": STUB_REPLY}}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for word in STUB_REPLY.split(" "):
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+                time.sleep(self.token_interval)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except OSError:
+            pass  # Client stopped the stream early
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_stub(port_queue, latency, token_interval, error_rate, seed):
+    StubOpenAIHandler.latency = latency
+    StubOpenAIHandler.token_interval = token_interval
+    StubOpenAIHandler.error_rate = error_rate
+    StubOpenAIHandler.rng = random.Random(seed)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stub(args):
+    """Stub server in its own process so it doesn't share our event loop or GIL"""
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    process = context.Process(target=serve_stub, daemon=True, args=(
+        port_queue, args.latency / 1000, args.token_interval / 1000, args.error_rate, args.seed))
+    process.start()
+    return process, port_queue.get(timeout=15)
+
+
+# =============== FAKE TELEGRAM ===============
+
+class FakeChat:
+    def __init__(self, chat_id, private):
+        self.id = chat_id
+        self.username = None
+        self.title = None if private else f"Load group {chat_id}"
+
+
+class FakeSender:
+    def __init__(self, sender_id):
+        self.id = sender_id
+        self.username = f"user{sender_id}"
+        self.first_name = f"User {sender_id}"
+
+
+class FakeMessage:
+    def __init__(self, text, reply_to_msg_id=None, message_id=None):
+        self.id = message_id
+        self.message = text
+        self.reply_to_msg_id = reply_to_msg_id
+        self.is_reply = reply_to_msg_id is not None
+        self.date = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class FakeEvent:
+    def __init__(self, run, message_id, chat, sender, text, reply_to_msg_id):
+        self.run = run
+        self.id = message_id
+        self.out = False
+        self.is_private = chat.title is None
+        self.is_group = not self.is_private
+        self.is_channel = self.is_group  # Load groups are supergroups
+        self.chat_id = chat.id
+        self.chat = chat
+        self.sender = sender
+        self.sender_id = sender.id
+        self.message = FakeMessage(text, reply_to_msg_id, message_id)
+
+    async def get_chat(self):
+        return self.chat
+
+    async def get_sender(self):
+        return self.sender
+
+    async def reply(self, text):
+        return self.run.record_reply(self, text)
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeClient:
+    def action(self, chat, action):
+        return FakeTyping()
+
+
+class FakeMe:
+    id = BOT_ID
+    username = BOT_USERNAME
+
+
+# =============== LOAD RUN ===============
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class LoadRun:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.corpus = build_corpus(max(args.messages, 100), args.seed)
+        self.groups = [FakeChat(-1000000000 - i, private=False) for i in range(args.chats)]
+        self.senders = [FakeSender(1000 + i) for i in range(args.senders)]
+        self.sent_at = {}
+        self.bot_messages = {}  # chat id -> ids of the bot's replies there
+        self.latencies = []
+        self.replies = 0
+        self.loop_lags = []
+        self.in_flight = 0
+
+    def make_event(self, message_id):
+        args = self.args
+        sender = self.rng.choice(self.senders)
+        if self.rng.random() < args.dm_ratio:
+            chat = FakeChat(sender.id, private=True)
+        else:
+            chat = self.rng.choice(self.groups)
+        text = self.rng.choice(self.corpus)
+        if self.rng.random() < args.mention_ratio:
+            text = f"@{BOT_USERNAME} {text}"
+        reply_to = None
+        if self.rng.random() < args.reply_ratio and self.bot_messages.get(chat.id):
+            reply_to = self.rng.choice(self.bot_messages[chat.id])
+        return FakeEvent(self, message_id, chat, sender, text, reply_to)
+
+    def record_reply(self, event, text):
+        self.replies += 1
+        self.latencies.append(time.perf_counter() - self.sent_at[event.id])
+        sent = FakeMessage(text, message_id=1000000 + self.replies)
+        self.bot_messages.setdefault(event.chat_id, []).append(sent.id)
+        return sent
+
+    async def watch_loop_lag(self, interval=0.05):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.perf_counter() - start - interval)
+
+    async def run(self):
+        args = self.args
+        handler = main.make_message_handler(FakeClient(), FakeMe(), main.SYLVIA_PERSONA)
+        dispatcher = handler.dispatcher
+        process_batch = dispatcher.process_batch
+
+        async def counted_batch(chat_id, batch):
+            self.in_flight += 1
+            try:
+                await process_batch(chat_id, batch)
+            finally:
+                self.in_flight -= 1
+        dispatcher.process_batch = counted_batch
+
+        lag_task = asyncio.create_task(self.watch_loop_lag())
+        start = time.perf_counter()
+        next_send = start
+        for message_id in range(1, args.messages + 1):
+            next_send += self.rng.expovariate(args.rate)
+            wait = next_send - time.perf_counter()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            event = self.make_event(message_id)
+            self.sent_at[message_id] = time.perf_counter()
+            if main.prefilter_event(event):  # What Telethon's event filter does before the handler
+                await handler(event)
+        send_done = time.perf_counter()
+
+        # Drain: nothing queued and no batch being processed
+        while self.in_flight or any(not q.empty() for q in dispatcher.queues.values()):
+            await asyncio.sleep(0.05)
+        end = time.perf_counter()
+        lag_task.cancel()
+        return send_done - start, end - start
+
+
+def scale_human_delays(scale):
+    """Shrink the minimum response time respond() pads replies to, keep every other sleep real"""
+    wait_for_reply = main.wait_for_reply
+
+    async def scaled_wait(reply_task, started, min_total):
+        return await wait_for_reply(reply_task, started, min_total * scale)
+    main.wait_for_reply = scaled_wait
+    return wait_for_reply
+
+
+def report(run, send_time, total_time):
+    args = run.args
+    ms = lambda seconds: seconds * 1000
+    timing = main.RESPONSE_TIMING_STATS
+    print(f"\n📊 Load test: {args.messages} messages over {send_time:.1f}s "
+          f"({args.chats} groups, {args.senders} senders, {args.rate:g} msg/s offered)")
+    print(f"  replies           {run.replies} ({run.replies / total_time:.2f} replies/s, drained in {total_time:.1f}s)")
+    print(f"  end-to-end ms     p50 {ms(percentile(run.latencies, 50)):.0f}  p95 {ms(percentile(run.latencies, 95)):.0f}  "
+          f"p99 {ms(percentile(run.latencies, 99)):.0f}  max {ms(max(run.latencies, default=float('nan'))):.0f}")
+    if timing["replies"]:
+        print(f"  model call ms     avg {ms(timing['model_total'] / timing['replies']):.0f}")
+    print(f"  event loop lag ms p50 {ms(percentile(run.loop_lags, 50)):.1f}  p99 {ms(percentile(run.loop_lags, 99)):.1f}  "
+          f"max {ms(max(run.loop_lags, default=float('nan'))):.1f}")
+    stats = main.DISPATCHER_STATS
+    print(f"  dispatcher        {stats['batches']} batches, {stats['coalesced']} coalesced, "
+          f"{stats['dropped']} dropped, max depth {stats['max_depth']}")
+    print(f"  pre-filter        {main.format_prefilter_stats()}")
+    print(f"  entity cache      {main.format_entity_cache_stats()}")
+    stats = main.RESILIENCE_STATS
+    print(f"  upstream          {stats['attempts']} attempts, {stats['retries']} retries, "
+          f"{stats['gave_up']} gave up, {stats['fast_failures']} failed fast")
+
+
+async def run_load(args, port):
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    main.OPENAI_BASE_URL = f"http://127.0.0.1:{port}/v1"
+    main.OPENAI_API_KEY = "loadtest"
+    main.OPENAI_STREAM = not args.no_stream
+    main.HISTORY_DIR = os.path.join(workdir, "chat_histories")
+    main.HISTORY_DB_PATH = os.path.join(workdir, "chat_histories.db")
+    main.COALESCE_WINDOW = args.coalesce_window
+    main.REPLY_PROBABILITY = args.reply_probability
+
+    run = LoadRun(args)
+    main.ALLOWED_GROUP_IDS[:] = [chat.id for chat in run.groups]
+    main._allowed_chat_ids.update(main.ALLOWED_GROUP_IDS)  # What resolve_allowed_chats does at startup
+
+    wait_for_reply = scale_human_delays(args.time_scale)
+    main.start_history_flusher()
+    try:
+        await main.prewarm_http_client()
+        send_time, total_time = await run.run()
+    finally:
+        main.wait_for_reply = wait_for_reply
+        await main.stop_history_flusher()
+        await main.close_http_client()
+        shutil.rmtree(workdir, ignore_errors=True)
+    report(run, send_time, total_time)
+
+
+def main_loadtest():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500, help="messages to send")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second (Poisson arrivals)")
+    parser.add_argument("--chats", type=int, default=20, help="group chats")
+    parser.add_argument("--senders", type=int, default=50, help="distinct users")
+    parser.add_argument("--dm-ratio", type=float, default=0.1, help="share of messages sent as DMs")
+    parser.add_argument("--mention-ratio", type=float, default=0.2, help="share of group messages mentioning the bot")
+    parser.add_argument("--reply-ratio", type=float, default=0.1, help="share of group messages replying to the bot")
+    parser.add_argument("--reply-probability", type=float, default=main.REPLY_PROBABILITY,
+                        help="random engagement chance in groups")
+    parser.add_argument("--latency", type=float, default=500, help="stub time to first token, ms")
+    parser.add_argument("--token-interval", type=float, default=10, help="stub time between streamed tokens, ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stub responses that are 429/503")
+    parser.add_argument("--no-stream", action="store_true", help="use non-streaming completions")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="multiplier for the bot's human-like reply delay (0 skips it, 1 is real time)")
+    parser.add_argument("--coalesce-window", type=float, default=main.COALESCE_WINDOW,
+                        help="burst coalescing window, seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    stub, port = start_stub(args)
+    try:
+        asyncio.run(run_load(args, port))
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main_loadtest()
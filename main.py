@@ -1,28 +1,413 @@
+import time
+_MODULE_LOAD_STARTED = time.perf_counter()
 import asyncio
 import random
 import os
 import json
-import pdfplumber
-import httpx
-import nest_asyncio
-import time
+import functools
 import re
+import sqlite3
+import sys
+import threading
+import traceback
 import base64
+import contextlib
+import contextvars
+import email.utils
+import bisect
 import hashlib
+import multiprocessing
+import shutil
+import tempfile
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from datetime import datetime, timedelta, UTC
-from textblob import TextBlob
-import requests
 from dotenv import load_dotenv
 load_dotenv()
 
-# Download NLTK data if not present (for sentiment analysis)
-try:
-    import nltk
-    nltk.download('punkt', quiet=True)
-    nltk.download('brown', quiet=True)
-except:
-    print("⚠️ NLTK data download failed - sentiment analysis may not work")
+# Importing this module has no side effects beyond reading .env: accounts,
+# PDF knowledge, NLTK corpora and TextBlob are all loaded on first use by the
+# lazy loaders below, and heavy libraries are imported where they are needed.
+
+NLTK_CORPORA = {"punkt": "tokenizers/punkt", "brown": "corpora/brown"}
+
+_nltk_checked = False
+_TextBlob = None
+
+
+def ensure_nltk_corpora():
+    """Check (locally, once) that the NLTK data TextBlob needs is installed"""
+    global _nltk_checked
+    if _nltk_checked:
+        return
+    _nltk_checked = True
+    try:
+        import nltk
+        missing = []
+        for name, resource in NLTK_CORPORA.items():
+            try:
+                nltk.data.find(resource)
+            except LookupError:
+                missing.append(name)
+        if missing:
+            print(f"⚠️ NLTK data missing ({', '.join(missing)}) - run setup.py, sentiment analysis may not work")
+    except ImportError:
+        print("⚠️ NLTK not installed - sentiment analysis may not work")
+
+
+def get_textblob():
+    """Import TextBlob on first use"""
+    global _TextBlob
+    if _TextBlob is None:
+        ensure_nltk_corpora()
+        from textblob import TextBlob
+        _TextBlob = TextBlob
+    return _TextBlob
+
+
+# =============== METRICS ===============
+# Latency histograms per pipeline stage plus event counters, kept in process
+# and optionally served in Prometheus text format on METRICS_PORT (localhost
+# only). The *_STATS dicts of the other sections are exported as gauges.
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the endpoint
+METRICS_HOST = "127.0.0.1"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+
+_histograms = {}  # stage -> Histogram
+_counters = {}  # name -> int
+_metrics_server = None
+
+
+def observe(stage, seconds):
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        histogram = _histograms[stage] = Histogram()
+    histogram.observe(seconds)
+
+
+def count(name, amount=1):
+    _counters[name] = _counters.get(name, 0) + amount
+
+
+async def timed_await(stage, awaitable):
+    """Await something and record how long it took under stage, as a trace span too"""
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            return await awaitable
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+class StageTimer:
+    """Records the time since the previous lap under each lap's stage, as a trace span too"""
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        observe(stage, now - self.last)
+        record_span(stage, now - self.last)
+        self.last = now
+
+
+def _stats_gauges():
+    """Numeric values of the sections' stats dicts, resolved when scraped"""
+    sources = {
+        "history_cache": "HISTORY_CACHE_STATS", "http": "HTTP_METRICS", "stream": "STREAM_STATS",
+        "resilience": "RESILIENCE_STATS", "prompt": "PROMPT_STATS", "response_timing": "RESPONSE_TIMING_STATS",
+        "shard": "SHARD_STATS", "dispatcher": "DISPATCHER_STATS", "trace": "TRACE_STATS",
+        "entity_cache": "ENTITY_CACHE_STATS", "prefilter": "PREFILTER_STATS",
+        "offload": "OFFLOAD_STATS"
+    }
+    for prefix, name in sources.items():
+        for key, value in globals().get(name, {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f"sylvia_{prefix}_{key}", value
+
+
+def render_metrics():
+    """Everything in Prometheus text exposition format"""
+    lines = ["# TYPE sylvia_stage_seconds histogram"]
+    for stage, histogram in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+            cumulative += bucket_count
+            lines.append(f'sylvia_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'sylvia_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'sylvia_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'sylvia_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+    for name, value in sorted(_counters.items()):
+        lines.append(f"# TYPE sylvia_{name}_total counter")
+        lines.append(f"sylvia_{name}_total {value}")
+    for name, value in _stats_gauges():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # Skip headers
+        if request_line.split(b" ")[1:2] in ([b"/metrics"], [b"/"]):
+            status, body = "200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port=None):
+    global _metrics_server
+    port = METRICS_PORT if port is None else port
+    if port and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(_serve_metrics, METRICS_HOST, port)
+        print(f"📈 Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+
+# =============== TRACING ===============
+# A sampled message gets one span tree: a root span from the moment the
+# message arrived carrying chat id, message id and the reply decision, a
+# queue_wait span for the coalesce window and per-chat queue, and a child for
+# every timed_await and StageTimer lap. The current span travels in a
+# contextvar, so tasks started while handling the message inherit it.
+# Unsampled messages cost one random() call. Finished spans are exported every few seconds to a rotating
+# JSONL file, or as OTLP/HTTP JSON when OTEL_EXPORTER_OTLP_ENDPOINT is set.
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))  # Share of messages traced, 0 disables tracing
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024  # Rotated to traces.jsonl.1 .. .3 past this
+TRACE_FILE_BACKUPS = 3
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")  # e.g. http://localhost:4318
+TRACE_EXPORT_INTERVAL = 2  # Seconds
+TRACE_BUFFER_LIMIT = 10000  # Finished spans waiting for export, newer ones are dropped past this
+
+TRACE_STATS = {
+    "traces": 0,
+    "spans": 0,
+    "exported": 0,
+    "dropped": 0,
+    "export_errors": 0
+}
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_finished_spans = []
+_trace_exporter_task = None
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+        TRACE_STATS["spans"] += 1
+        if len(_finished_spans) < TRACE_BUFFER_LIMIT:
+            _finished_spans.append(self)
+        else:
+            TRACE_STATS["dropped"] += 1
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+def start_trace(name, start_ns=None, **attributes):
+    """Root span for one message, None when the message isn't sampled"""
+    if TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE:
+        return None
+    TRACE_STATS["traces"] += 1
+    return Span(name, os.urandom(16).hex(), attributes=attributes, start_ns=start_ns)
+
+
+@contextlib.contextmanager
+def use_span(current):
+    """Make a span current for the block, None does nothing"""
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Child of the current span for the block, free when the message isn't traced"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def record_span(name, seconds):
+    """Child of the current span that just ended after running for seconds"""
+    parent = _current_span.get()
+    if parent is not None:
+        end_ns = time.time_ns()
+        Span(name, parent.trace_id, parent.span_id, start_ns=end_ns - int(seconds * 1e9)).end(end_ns)
+
+
+def _rotate_trace_file():
+    for index in range(TRACE_FILE_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{TRACE_FILE}.{index}"):
+            os.replace(f"{TRACE_FILE}.{index}", f"{TRACE_FILE}.{index + 1}")
+    os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+
+
+def _write_trace_file(records):
+    if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+        _rotate_trace_file()
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(spans):
+    """OTLP/HTTP JSON body for a batch of finished spans"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "sylvia-bot"}}]},
+        "scopeSpans": [{
+            "scope": {"name": "main"},
+            "spans": [{
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 0}
+            } for s in spans]
+        }]
+    }]}
+
+
+async def flush_traces(otlp_client=None):
+    global _finished_spans
+    if not _finished_spans:
+        return
+    batch, _finished_spans = _finished_spans, []
+    try:
+        if otlp_client is not None:
+            response = await otlp_client.post(f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces", json=_otlp_payload(batch))
+            response.raise_for_status()
+        else:
+            records = [s.to_dict() for s in batch]
+            await asyncio.get_running_loop().run_in_executor(None, _write_trace_file, records)
+        TRACE_STATS["exported"] += len(batch)
+    except Exception as e:
+        TRACE_STATS["export_errors"] += 1
+        print(f"⚠️ Trace export failed ({len(batch)} spans): {e}")
+
+
+async def trace_export_loop():
+    otlp_client = None
+    if OTLP_ENDPOINT:
+        import httpx
+        otlp_client = httpx.AsyncClient(timeout=10)
+    try:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await flush_traces(otlp_client)
+    finally:
+        await flush_traces(otlp_client)
+        if otlp_client is not None:
+            await otlp_client.aclose()
+
+
+def start_trace_exporter():
+    global _trace_exporter_task
+    if TRACE_SAMPLE_RATE > 0 and (_trace_exporter_task is None or _trace_exporter_task.done()):
+        _trace_exporter_task = asyncio.create_task(trace_export_loop())
+        print(f"🔎 Tracing {TRACE_SAMPLE_RATE:.0%} of messages to {OTLP_ENDPOINT or TRACE_FILE}")
+
+
+async def stop_trace_exporter():
+    global _trace_exporter_task
+    if _trace_exporter_task is not None:
+        _trace_exporter_task.cancel()
+        try:
+            await _trace_exporter_task
+        except asyncio.CancelledError:
+            pass
+        _trace_exporter_task = None
 
 
 def get_current_shift_index():
@@ -47,12 +432,129 @@ def get_time_based_mood():
     else:
         return "night"  # Tired but still gaming, late night vibes
 
+# =============== SENTIMENT ===============
+# get_sentiment_analysis buckets a polarity score from a pluggable engine:
+# "lexicon" (default) is a precompiled word list covering English, gamer slang,
+# Arabic and Arabizi seen in the chats, "textblob" is the old TextBlob pattern
+# analyzer. Scores are cached on the normalized text.
+
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "lexicon").lower()  # "lexicon" or "textblob"
+SENTIMENT_CACHE_SIZE = 4096
+
+SENTIMENT_LEXICON = {
+    # English
+    "love": 0.6, "loved": 0.6, "loving": 0.6, "like": 0.2, "good": 0.7, "great": 0.8, "nice": 0.6,
+    "cool": 0.35, "awesome": 0.9, "amazing": 0.7, "best": 0.9, "better": 0.5, "perfect": 1.0,
+    "beautiful": 0.85, "happy": 0.8, "excited": 0.5, "fun": 0.4, "funny": 0.3, "wow": 0.3,
+    "thanks": 0.3, "thank": 0.3, "thx": 0.3, "welcome": 0.5, "glad": 0.5, "enjoy": 0.5,
+    "excellent": 1.0, "fantastic": 0.9, "incredible": 0.8, "brilliant": 0.9, "wonderful": 1.0,
+    "yay": 0.6, "congrats": 0.6, "win": 0.5, "won": 0.5, "winning": 0.5,
+    "hate": -0.8, "bad": -0.7, "worst": -1.0, "awful": -1.0, "terrible": -1.0, "horrible": -1.0,
+    "boring": -0.8, "sad": -0.5, "angry": -0.5, "annoying": -0.6, "annoyed": -0.5, "broken": -0.4,
+    "stupid": -0.8, "ugly": -0.7, "sucks": -0.7, "suck": -0.7, "frustrating": -0.6,
+    "frustrated": -0.6, "problem": -0.3, "issue": -0.2, "bug": -0.3, "bugs": -0.3, "fail": -0.5,
+    "failed": -0.5, "lost": -0.3, "lose": -0.3, "losing": -0.3, "tired": -0.3, "sorry": -0.2,
+    "wrong": -0.5, "useless": -0.6, "disappointed": -0.7, "scam": -0.8,
+    # Gamer / internet slang
+    "fire": 0.6, "lit": 0.6, "goat": 0.7, "goated": 0.8, "based": 0.4, "iconic": 0.6, "slay": 0.6,
+    "hype": 0.5, "hyped": 0.6, "poggers": 0.7, "pog": 0.6, "gg": 0.4, "ez": 0.2, "clutch": 0.5,
+    "op": 0.3, "epic": 0.6, "legendary": 0.7, "valid": 0.3, "lol": 0.4, "lmao": 0.4, "haha": 0.4,
+    "hehe": 0.4, "lmfao": 0.4, "xd": 0.4, "ily": 0.7,
+    "mid": -0.4, "trash": -0.7, "cringe": -0.6, "lag": -0.4, "laggy": -0.5, "noob": -0.3,
+    "rip": -0.3, "nerf": -0.2, "nerfed": -0.3, "toxic": -0.6, "ragequit": -0.6, "tilted": -0.5,
+    "smh": -0.4, "ugh": -0.4, "meh": -0.2, "bruh": -0.1,
+    # Arabizi
+    "habibi": 0.4, "habibti": 0.4, "yalla": 0.2, "mashallah": 0.7, "inshallah": 0.2,
+    "hamdulillah": 0.5, "alhamdulillah": 0.5, "helw": 0.6, "helwa": 0.6, "7elw": 0.6, "7elwa": 0.6,
+    "zaki": 0.5, "tamam": 0.4, "mabrook": 0.7, "walla": 0.1, "wallah": 0.1, "yaani": 0.0,
+    "khara": -0.8, "zift": -0.7, "3ayb": -0.4, "ya3ni": 0.0,
+    # Arabic (normalized: alef forms -> ا, ة -> ه, ى -> ي)
+    "حلو": 0.6, "حلوه": 0.6, "جميل": 0.7, "جميله": 0.7, "رائع": 0.9, "رايع": 0.9, "ممتاز": 0.9,
+    "ممتازه": 0.9, "تحفه": 0.8, "حبيبي": 0.4, "حبيبتي": 0.4, "احبك": 0.7, "حب": 0.5, "الورد": 0.4,
+    "الحمدلله": 0.5, "ماشاءالله": 0.7, "مبروك": 0.7, "شكرا": 0.4, "تشرفنا": 0.5, "يسلمو": 0.5,
+    "اهلا": 0.4, "مرحبا": 0.3, "النور": 0.3, "السرور": 0.5, "زين": 0.5, "كويس": 0.5, "تمام": 0.4,
+    "هه": 0.3, "خخخ": 0.3, "عظيم": 0.8, "قوي": 0.3, "بطل": 0.5,
+    "زفت": -0.7, "سيء": -0.7, "سيئ": -0.7, "وحش": -0.5, "زعلان": -0.5, "حزين": -0.6, "ممل": -0.7,
+    "خرا": -0.8, "يلعن": -0.8, "تعبان": -0.4, "مشكله": -0.3, "غلط": -0.5, "كذاب": -0.6, "نصاب": -0.8,
+    # Emoji
+    "❤": 0.6, "😍": 0.8, "🥰": 0.8, "😊": 0.5, "😁": 0.5, "😂": 0.4, "🤣": 0.4, "🔥": 0.5, "💯": 0.5,
+    "👍": 0.4, "🎉": 0.6, "✨": 0.3, "💪": 0.4, "😎": 0.4, "🙏": 0.3,
+    "😡": -0.7, "😠": -0.6, "😢": -0.5, "😭": -0.3, "💔": -0.6, "👎": -0.5, "🙄": -0.3, "😤": -0.4,
+}
+
+SENTIMENT_NEGATORS = frozenset([
+    "not", "no", "never", "dont", "don't", "doesnt", "doesn't", "isnt", "isn't", "wasnt", "wasn't",
+    "aint", "ain't", "cant", "can't", "wont", "won't", "nothing", "ما", "مش", "مو", "لا", "مب", "mish", "mesh",
+])
+SENTIMENT_INTENSIFIERS = {
+    "so": 1.3, "soo": 1.3, "very": 1.3, "really": 1.3, "super": 1.4, "extremely": 1.5, "literally": 1.2,
+    "absolutely": 1.4, "totally": 1.3, "kteer": 1.3, "ktir": 1.3, "كثير": 1.3, "كتير": 1.3, "جدا": 1.4,
+    "مره": 1.3, "واجد": 1.3,
+}
+
+_ARABIC_DIACRITICS = re.compile(r"[\u064B-\u0652\u0640]")  # Tashkeel and tatweel
+_ARABIC_LETTER_FORMS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ة": "ه", "ى": "ي"})
+_REPEATED_CHARS = re.compile(r"(.)\1{2,}")
+_LAUGHTER = re.compile(r"\b(h[ae])\1+h?\b")  # "hahaha", "hehehe", "hahah"
+_SENTIMENT_TOKENS = re.compile(r"[\w']+|[\u2600-\u27BF\U0001F300-\U0001FAFF]")
+
+
+def normalize_sentiment_text(text):
+    """Lowercase, unify Arabic letter forms, squeeze stretched letters ("sooo" -> "soo") and laughter ("hahaha" -> "haha")"""
+    text = _ARABIC_DIACRITICS.sub("", text.lower()).translate(_ARABIC_LETTER_FORMS)
+    text = _REPEATED_CHARS.sub(r"\1\1", " ".join(text.split()))
+    return _LAUGHTER.sub(r"\1\1", text)
+
+
+@functools.lru_cache(maxsize=SENTIMENT_CACHE_SIZE)
+def lexicon_polarity(normalized_text):
+    """Mean lexicon score of the sentiment words in a normalized message, -1 to 1"""
+    scores = []
+    negate, boost = False, 1.0
+    for token in _SENTIMENT_TOKENS.findall(normalized_text):
+        if token in SENTIMENT_NEGATORS:
+            negate = True
+            continue
+        if token in SENTIMENT_INTENSIFIERS:
+            boost *= SENTIMENT_INTENSIFIERS[token]
+            continue
+        score = SENTIMENT_LEXICON.get(token)
+        if score is None and token.startswith("ال"):
+            score = SENTIMENT_LEXICON.get(token[2:])  # Arabic definite article
+        if score is None and token.startswith("هه"):
+            score = SENTIMENT_LEXICON["هه"]  # Arabic laughter of any length
+        if score is None:
+            continue
+        if negate:
+            score *= -0.5
+        scores.append(max(-1.0, min(1.0, score * boost)))
+        negate, boost = False, 1.0
+    if not scores:
+        return 0.0
+    return sum(scores) / len(scores)
+
+
+@functools.lru_cache(maxsize=SENTIMENT_CACHE_SIZE)
+def textblob_polarity(normalized_text):
+    return get_textblob()(normalized_text).sentiment.polarity
+
+
+SENTIMENT_ENGINES = {
+    "lexicon": lexicon_polarity,
+    "textblob": textblob_polarity,
+}
+
+
+def get_sentiment_polarity(text, backend=None):
+    """Polarity from -1 to 1 using the configured (or given) engine"""
+    engine = SENTIMENT_ENGINES.get(backend or SENTIMENT_BACKEND, lexicon_polarity)
+    return engine(normalize_sentiment_text(text))
+
+
 def get_sentiment_analysis(text):
     """Analyze sentiment of user message"""
     try:
-        blob = TextBlob(text)
-        polarity = blob.sentiment.polarity  # -1 to 1
-        subjectivity = blob.sentiment.subjectivity  # 0 to 1
+        polarity = get_sentiment_polarity(text)  # -1 to 1
         
         if polarity > 0.1:
             return "positive"
@@ -281,6 +783,244 @@ def get_quick_tip():
     return random.choice(tips)
 
 
+# =============== INTENT ROUTER ===============
+# Every keyword check in the bot lives in INTENT_TABLE. The table is compiled
+# once into a single word-bounded regex, so one pass over a message returns
+# every matched intent, ordered by priority (lowest number first).
+
+INTENT_TABLE = [
+    # (intent, priority, keyword patterns)
+    # Canned quick replies, checked in this order by get_human_reply
+    ("joke", 10, [r"jokes?", r"funny", r"laugh\w*", r"humou?r"]),
+    ("weather", 20, [r"weather", r"outside", r"sunny", r"rainy"]),
+    ("doesnt_exist", 30, [r"doesn['’]t exist", r"not real", r"doesn['’]t even exist"]),
+    ("quote", 40, [r"quotes?", r"inspir\w*", r"motivation"]),
+    ("greeting", 50, [r"hi+", r"hel+o+", r"hey+"]),
+    ("status", 60, [r"how are (?:you|u)", r"hru", r"what['’]?s up", r"wyd"]),
+    ("laugh", 70, [r"lo+l+", r"(?:ha){2,}h?", r"funny"]),
+    ("math", 80, [r"math", r"calculate"]),
+    ("password", 90, [r"passwords?", r"pass", r"generate password"]),
+    ("coin", 100, [r"flip (?:a )?coin", r"coin flip", r"heads or tails"]),
+    ("dice", 110, [r"roll (?:a )?dice", r"dice", r"random number"]),
+    ("food", 120, [r"food", r"eat", r"hungry", r"dinner", r"lunch"]),
+    ("tip", 130, [r"tips?", r"advice", r"help me"]),
+    ("color", 140, [r"colou?rs?"]),
+    ("help", 150, [r"help", r"commands", r"what can you do"]),
+    # Conversation signals, used for topic tracking and prompt context
+    ("gaming", 200, [r"\w*game\w*", r"gaming", r"play\w*", r"rpgs?", r"strateg\w*"]),
+    ("game_title", 210, [r"rpgs?", r"strateg\w*", r"fantasy", r"astra", r"baldur\w*", r"elden", r"witcher"]),
+    ("tech", 220, [r"code", r"coding", r"programming", r"bugs?", r"debug\w*"]),
+    ("food_topic", 230, [r"food", r"eat", r"hungry"]),
+    ("engage", 240, [r"raids?", r"boss\w*", r"level\w*", r"patch\w*", r"updates?", r"tech", r"code",
+                     r"dev\w*"]),
+    ("mood_excited", 300, [r"excited", r"awesome", r"amazing", r"love", r"great"]),
+    ("mood_frustrated", 310, [r"bugs?", r"problems?", r"issues?", r"broken", r"doesn['’]t work"]),
+    ("mood_playful", 320, [r"funny", r"lo+l+", r"(?:ha){2,}h?", r"jokes?"]),
+    # Game titles, "game:<name>" intents feed ChatContext.mentioned_games
+    ("game:Fallout", 400, [r"fallout"]),
+    ("game:Baldur's Gate", 401, [r"baldur\w*"]),
+    ("game:Baldur's Gate 3", 402, [r"bg3"]),
+    ("game:Elden Ring", 403, [r"elden"]),
+    ("game:The Witcher", 404, [r"witcher"]),
+    ("game:Cyberpunk", 405, [r"cyberpunk"]),
+    ("game:Skyrim", 406, [r"skyrim"]),
+    ("game:Minecraft", 407, [r"minecraft"]),
+    ("game:Valorant", 408, [r"valorant"]),
+    ("game:League of Legends", 409, [r"league"]),
+    ("game:Astra Nova", 410, [r"astra"]),
+]
+
+
+def _compile_intent_table(table):
+    """Build the combined matcher and the per-pattern matchers used to resolve a hit"""
+    priorities = {}
+    pattern_intents = {}
+    for intent, priority, patterns in table:
+        priorities[intent] = priority
+        for pattern in patterns:
+            pattern_intents.setdefault(pattern, []).append(intent)
+    # Longer alternatives first so "help me" wins over "help" at the same position
+    alternatives = sorted(pattern_intents, key=len, reverse=True)
+    combined = re.compile(r"\b(?:" + "|".join(alternatives) + r")\b")
+    resolvers = [(re.compile(rf"\b(?:{pattern})\b"), intents) for pattern, intents in pattern_intents.items()]
+    return combined, resolvers, priorities
+
+
+_INTENT_MATCHER, _INTENT_RESOLVERS, INTENT_PRIORITIES = _compile_intent_table(INTENT_TABLE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _intents_for_match(matched):
+    """Every intent whose keyword occurs (as whole words) in one matched span"""
+    found = set()
+    for regex, intents in _INTENT_RESOLVERS:
+        if regex.search(matched):
+            found.update(intents)
+    return frozenset(found)
+
+
+def route_message(message):
+    """All intents matched by a message, highest priority first"""
+    found = set()
+    for match in _INTENT_MATCHER.finditer(message.lower()):
+        found |= _intents_for_match(match.group())
+    return sorted(found, key=INTENT_PRIORITIES.__getitem__)
+
+
+# Quick reply builders for the canned intents; returning None falls through
+# to the next matched intent and eventually the model.
+
+def _reply_joke(message):
+    return get_random_joke()
+
+
+def _reply_weather(message):
+    return f"yalla, {get_weather_greeting()}"
+
+
+def _reply_doesnt_exist(message):
+    confusion_responses = [
+        "wait what?? what doesn't exist bestie",
+        "hold up what are you talking about that doesn't exist",
+        "omg what do you mean it doesn't exist",
+        "bestie i'm confused what doesn't exist"
+    ]
+    return random.choice(confusion_responses)
+
+
+def _reply_quote(message):
+    return get_random_quote()
+
+
+def _reply_greeting(message):
+    greetings = [
+        "YOOO what's good bestie", "omg heyyyy", "bestie you're here", 
+        "aywa what's the tea", "heyyy gorgeous", "omg perfect timing",
+        "yesss bestie energy", "hey babe what's up", "omg hiiii"
+    ]
+    greeting = random.choice(greetings)
+    if random.random() < 0.4:
+        greeting += f" {get_chaotic_response()}"
+    return greeting
+
+
+def _reply_status(message):
+    status_responses = [
+        "absolutely THRIVING bestie", "living my best chaotic life", 
+        "buzzing with caffeine and good vibes", "feeling iconic as usual",
+        "riding the dopamine wave", "absolutely WINNING today",
+        "vibing at maximum capacity", "channeling main character energy",
+        "existing in the best possible way", "feeling absolutely unstoppable"
+    ]
+    status = random.choice(status_responses)
+    if random.random() < 0.3:
+        status += f" also {get_relatable_struggle()}"
+    return status
+
+
+def _reply_laugh(message):
+    laugh_responses = [
+        "RIGHT?? I'm literally crying", "bestie you GET IT", "no but seriously this is sending me",
+        "the way i WHEEZED", "absolutely ICONIC", "bestie stop i can't breathe",
+        "literally same energy", "this is peak comedy", "i'm so here for this"
+    ]
+    return random.choice(laugh_responses)
+
+
+def _reply_math(message):
+    if not any(c in message for c in "+-*/"):
+        return None
+    # Extract math expression
+    math_expr = re.findall(r'[\d+\-*/\.\(\) ]+', message)
+    if math_expr:
+        return calculate_simple_math(math_expr[0].strip())
+    return None
+
+
+def _reply_password(message):
+    length = 8
+    # Check if they specified length
+    numbers = re.findall(r'\d+', message)
+    if numbers:
+        length = min(int(numbers[0]), 20)  # Max 20 chars
+    return f"here: {get_password_generator(length)}"
+
+
+def _reply_coin(message):
+    return flip_coin()
+
+
+def _reply_dice(message):
+    return f"rolled {roll_dice()}"
+
+
+def _reply_food(message):
+    return get_random_food_suggestion()
+
+
+def _reply_tip(message):
+    return get_quick_tip()
+
+
+def _reply_color(message):
+    return f"today's vibe is {get_color_of_day()}"
+
+
+def _reply_help(message):
+    return """lol ok features:
+- jokes (say "joke")
+- facts (say "fact") 
+- quotes (say "quote")
+- math (like "calculate 2+2")
+- passwords (say "password")
+- coin flip (say "flip coin")
+- dice (say "roll dice")
+- food ideas (say "food")
+- tips (say "tip")
+- color of day (say "color")
+just text me like normal tho"""
+
+
+QUICK_REPLIES = {
+    "joke": _reply_joke,
+    "weather": _reply_weather,
+    "doesnt_exist": _reply_doesnt_exist,
+    "quote": _reply_quote,
+    "greeting": _reply_greeting,
+    "status": _reply_status,
+    "laugh": _reply_laugh,
+    "math": _reply_math,
+    "password": _reply_password,
+    "coin": _reply_coin,
+    "dice": _reply_dice,
+    "food": _reply_food,
+    "tip": _reply_tip,
+    "color": _reply_color,
+    "help": _reply_help,
+}
+
+
+def get_quick_reply(message, intents):
+    """Canned reply for the highest priority quick intent as (reply, save_to_history), reply None asks the model"""
+    # Jokes and weather always win. Otherwise gaming talk goes to the model
+    # instead of "doesn't exist" confusion or a random share
+    quick_intents = [intent for intent in intents if intent in QUICK_REPLIES]
+    if quick_intents and quick_intents[0] in ("joke", "weather"):
+        return QUICK_REPLIES[quick_intents[0]](message), True
+    if "gaming" not in intents:
+        if "doesnt_exist" in intents:
+            return _reply_doesnt_exist(message), True
+        if random.random() < 0.05:  # MUCH lower chance for random interruptions
+            return get_chaotic_response(), False  # Random shares aren't saved to history
+    for intent in quick_intents:
+        if intent == "doesnt_exist":
+            continue
+        response = QUICK_REPLIES[intent](message)
+        if response:
+            return response, True
+    return None, False
+
+
 # =============== CHAT MONITORING BACKEND ===============
 
 class ChatContext:
@@ -291,9 +1031,10 @@ class ChatContext:
         self.recent_messages = []
         self.users_in_chat = set()
         
-    def analyze_message(self, user_id, username, message):
+    def analyze_message(self, user_id, username, message, intents=None):
         """Analyze incoming message for context"""
-        msg_lower = message.lower()
+        if intents is None:
+            intents = route_message(message)
         
         # Track users
         self.users_in_chat.add(username)
@@ -311,38 +1052,26 @@ class ChatContext:
             self.recent_messages = self.recent_messages[-10:]
         
         # Detect topic changes
-        if any(word in msg_lower for word in ["game", "play", "gaming", "rpg", "strategy"]):
+        if "gaming" in intents:
             self.current_topic = "gaming"
-        elif any(word in msg_lower for word in ["code", "programming", "bug", "debug"]):
+        elif "tech" in intents:
             self.current_topic = "tech"
-        elif any(word in msg_lower for word in ["food", "eat", "hungry"]):
+        elif "food_topic" in intents:
             self.current_topic = "food"
         
         # Extract mentioned games
-        game_keywords = {
-            "fallout": "Fallout",
-            "baldur": "Baldur's Gate",
-            "bg3": "Baldur's Gate 3", 
-            "elden": "Elden Ring",
-            "witcher": "The Witcher",
-            "cyberpunk": "Cyberpunk",
-            "skyrim": "Skyrim",
-            "minecraft": "Minecraft",
-            "valorant": "Valorant",
-            "league": "League of Legends",
-            "astra": "Astra Nova"
-        }
-        
-        for keyword, game_name in game_keywords.items():
-            if keyword in msg_lower and game_name not in self.mentioned_games:
-                self.mentioned_games.append(game_name)
+        for intent in intents:
+            if intent.startswith("game:"):
+                game_name = intent[len("game:"):]
+                if game_name not in self.mentioned_games:
+                    self.mentioned_games.append(game_name)
                 
         # Detect conversation mood
-        if any(word in msg_lower for word in ["excited", "awesome", "amazing", "love", "great"]):
+        if "mood_excited" in intents:
             self.conversation_mood = "excited"
-        elif any(word in msg_lower for word in ["bug", "problem", "issue", "broken", "doesn't work"]):
+        elif "mood_frustrated" in intents:
             self.conversation_mood = "frustrated"
-        elif any(word in msg_lower for word in ["funny", "lol", "haha", "joke"]):
+        elif "mood_playful" in intents:
             self.conversation_mood = "playful"
     
     def get_context_summary(self):
@@ -393,21 +1122,25 @@ def get_chat_context(chat_id):
     return chat_contexts[chat_id]
 
 
-from difflib import SequenceMatcher
-from telethon import TelegramClient, events
-from telethon.errors import SessionPasswordNeededError
-
 # OpenAI Credentials — Use environment variables for security
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_ORG_ID = os.getenv("OPENAI_ORG_ID", "")
 
-nest_asyncio.apply()
+ACCOUNTS_PATH = "accounts.json"
+
+_accounts = None
 
-with open("accounts.json") as f:
-    ACCOUNTS = json.load(f)
 
-if len(ACCOUNTS) != 3:
-    raise ValueError("❌ You must define exactly 3 userbots in accounts.json")
+def load_accounts():
+    """Read accounts.json on first use"""
+    global _accounts
+    if _accounts is None:
+        with open(ACCOUNTS_PATH) as f:
+            accounts = json.load(f)
+        if len(accounts) != 3:
+            raise ValueError("❌ You must define exactly 3 userbots in accounts.json")
+        _accounts = accounts
+    return _accounts
 
 REPLY_PROBABILITY = 0.4  # Slightly more responsive
 CONTEXT_MSG_LIMIT = 15  # Better memory
@@ -427,24 +1160,96 @@ NIGHT_HOURS = (0, 6)  # 12 AM to 6 AM
 
 
 # Load PDF content for Sylvia context
+# Extracted text is cached in PDF_CACHE_PATH keyed by path, size, mtime and
+# content hash, so an unchanged PDF is never parsed twice. Only the first
+# PDF_CHAR_BUDGET characters are ever used, so extraction stops there.
+PDF_CHAR_BUDGET = 8000
+PDF_CACHE_PATH = os.getenv("PDF_CACHE_PATH", ".pdf_cache.json")
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_pdf_cache():
+    try:
+        with open(PDF_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_pdf_cache(cache):
+    try:
+        tmp_path = f"{PDF_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, PDF_CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not write PDF cache: {e}")
+
+
+def _parse_pdf_text(path, budget):
+    """Extract page text until more than `budget` characters have been read"""
+    import pdfplumber
+    text = ""
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + "\n"
+            if len(text) > budget:
+                break
+    return text
+
+
+def get_pdf_file_text(path, cache, budget=PDF_CHAR_BUDGET):
+    """Text of one PDF from the cache when unchanged, parsed otherwise. Returns (text, from_cache)"""
+    stat = os.stat(path)
+    entry = cache.get(path)
+    if entry and entry["budget"] >= budget:
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["text"], True
+        # Touched but maybe not modified (fresh checkout, copy), confirm by hash
+        if entry["size"] == stat.st_size and entry["sha256"] == _file_sha256(path):
+            entry["mtime"] = stat.st_mtime
+            return entry["text"], True
+    text = _parse_pdf_text(path, budget)
+    cache[path] = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": _file_sha256(path),
+        "budget": budget,
+        "text": text
+    }
+    return text, False
+
+
 def extract_pdf_text(directory="."):
     text = ""
     print("📚 Loading PDF context files...")
-    for file in os.listdir(directory):
+    cache = _load_pdf_cache()
+    cache_before = json.dumps(cache, sort_keys=True)
+    for file in sorted(os.listdir(directory)):
         if file.endswith('.pdf'):
+            if len(text) > PDF_CHAR_BUDGET:
+                break  # Budget already spent, the rest would be cut anyway
             try:
-                with pdfplumber.open(os.path.join(directory, file)) as pdf:
-                    for page in pdf.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                print(f"✅ Loaded {file}")
+                file_text, from_cache = get_pdf_file_text(os.path.join(directory, file), cache)
+                text += file_text
+                print(f"✅ Loaded {file}{' (cached)' if from_cache else ''}")
             except Exception as e:
                 print(f"⚠️ Warning: Could not read {file}: {e}")
+    if json.dumps(cache, sort_keys=True) != cache_before:
+        _save_pdf_cache(cache)
     
     if text:
         # Truncate to reasonable size
-        text = text[:8000] + "..." if len(text) > 8000 else text
+        text = text[:PDF_CHAR_BUDGET] + "..." if len(text) > PDF_CHAR_BUDGET else text
         print(f"📄 Total PDF content: {len(text)} characters")
     else:
         print("📄 No PDF content found")
@@ -452,14 +1257,23 @@ def extract_pdf_text(directory="."):
     return text
 
 
-try:
-    PDF_CONTENT = extract_pdf_text(".")
-except Exception as e:
-    print(f"⚠️ Could not load PDF content: {e}")
-    PDF_CONTENT = ""
+_pdf_content = None
+
+
+def get_pdf_content():
+    """PDF knowledge text, extracted on first use"""
+    global _pdf_content
+    if _pdf_content is None:
+        try:
+            _pdf_content = extract_pdf_text(".")
+        except Exception as e:
+            print(f"⚠️ Could not load PDF content: {e}")
+            _pdf_content = ""
+    return _pdf_content
 
-# Sylvia base prompt (insert your full base here)
-BASE_SYLVIA = f"""
+# Sylvia base prompt (insert your full base here); the PDF knowledge is
+# appended by get_base_sylvia()
+SYLVIA_PERSONA = """
 You are **Sylvia “Syl” Mappas** — 25, born in Amman, Jordan; half-Palestinian, half-Lebanese.  
 Middle child, chaotic kitchen upbringing, dad’s shipping logistics, mom’s famous catering hustle.  
 Expressive, sarcastic, hype-heavy, roast queen. Speak like a real human mixing Arabic & English slang naturally.  
@@ -1108,56 +1922,755 @@ Never write long paragraphs or multi-paragraph explanations.
 Speak like a fast, chaotic, hype gamer friend dropping quick lines.  
 If it feels like a long answer is needed, split it across multiple replies or keep it super concise.
 
-{PDF_CONTENT}
 """
 
-SYSTEM_TEXTS = [BASE_SYLVIA, BASE_SYLVIA, BASE_SYLVIA]
+_base_sylvia = None
+
+
+def get_base_sylvia():
+    """Full Sylvia system text (persona + PDF knowledge), built on first use"""
+    global _base_sylvia
+    if _base_sylvia is None:
+        _base_sylvia = f"{SYLVIA_PERSONA}{get_pdf_content()}\n"
+    return _base_sylvia
+
+
+def get_system_texts():
+    base = get_base_sylvia()
+    return [base, base, base]
+
+
+def __getattr__(name):
+    """Keep the old module-level names importable, resolved lazily"""
+    if name == "ACCOUNTS":
+        return load_accounts()
+    if name == "PDF_CONTENT":
+        return get_pdf_content()
+    if name == "BASE_SYLVIA":
+        return get_base_sylvia()
+    if name == "SYSTEM_TEXTS":
+        return get_system_texts()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Chat history stored on disk by chat_id as an append-only JSONL journal.
+# Each message is one line in chat_histories/<chat_id>.jsonl; the journal is
+# compacted back down to HISTORY_RETENTION_LIMIT lines once it grows past
+# HISTORY_COMPACT_THRESHOLD lines, so reads only ever need the file tail.
+# Prompts only use the last CONTEXT_MSG_LIMIT messages, the deeper retained
+# history feeds the similarity index.
+HISTORY_DIR = "chat_histories"
+HISTORY_RETENTION_LIMIT = int(os.getenv("HISTORY_RETENTION_LIMIT", "500"))  # Messages kept on disk per chat
+HISTORY_COMPACT_THRESHOLD = HISTORY_RETENTION_LIMIT * 2  # Lines before a background compaction
+HISTORY_TAIL_BLOCK_SIZE = 4096  # Bytes read per step when tail-seeking the journal
+
+_journal_line_counts = {}  # chat_id -> lines currently in the journal
+_journal_locks = {}  # chat_id -> lock shared by appends and compaction
+_journal_compacting = set()  # chat_ids with a compaction in flight
 
 
-# Chat history stored on disk by chat_id
 def get_history_filepath(chat_id):
-    os.makedirs("chat_histories", exist_ok=True)
-    return os.path.join("chat_histories", f"{chat_id}.json")
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    return os.path.join(HISTORY_DIR, f"{chat_id}.jsonl")
 
 
-def load_chat_history(chat_id):
+def get_legacy_history_filepath(chat_id):
+    """Path of the old whole-file JSON history for a chat"""
+    return os.path.join(HISTORY_DIR, f"{chat_id}.json")
+
+
+def _get_journal_lock(chat_id):
+    lock = _journal_locks.get(chat_id)
+    if lock is None:
+        lock = _journal_locks.setdefault(chat_id, threading.Lock())
+    return lock
+
+
+def _write_journal(path, history):
+    """Atomically replace a journal with the given messages"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in history:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def migrate_legacy_history(chat_id):
+    """Convert chat_histories/<chat_id>.json into the JSONL journal on first open"""
+    legacy_path = get_legacy_history_filepath(chat_id)
     path = get_history_filepath(chat_id)
+    if os.path.exists(path) or not os.path.exists(legacy_path):
+        return False
+    try:
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Could not migrate history for {chat_id}: {e}")
+        return False
+    history = history[-HISTORY_RETENTION_LIMIT:]
+    _write_journal(path, history)
+    os.remove(legacy_path)
+    _journal_line_counts[chat_id] = len(history)
+    print(f"📦 Migrated chat history {chat_id} to JSONL journal")
+    return True
+
+
+def _open_journal(chat_id):
+    """Return the journal path, migrating and counting lines the first time a chat is seen"""
+    path = get_history_filepath(chat_id)
+    if chat_id not in _journal_line_counts:
+        if not migrate_legacy_history(chat_id):
+            count = 0
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    count = sum(1 for _ in f)
+            _journal_line_counts[chat_id] = count
+    return path
+
+
+def _read_journal_tail(path, limit):
+    """Read the last `limit` lines of a journal by seeking backwards from the end"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # One extra newline is needed to know the first kept line is complete
+        while position > 0 and data.count(b"\n") <= limit:
+            step = min(HISTORY_TAIL_BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if position > 0:
+        lines = lines[1:]  # Drop the partial line where the seek landed
+    history = []
+    for line in lines[-limit:]:
+        if not line.strip():
+            continue
+        try:
+            history.append(json.loads(line))
+        except ValueError:
+            continue  # Torn write from a crash, skip it
+    return history
+
+
+def read_journal_history(chat_id, limit=None):
+    """Read the newest `limit` messages (default CONTEXT_MSG_LIMIT) straight from a journal"""
+    path = _open_journal(chat_id)
     if not os.path.exists(path):
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_journal_tail(path, limit or CONTEXT_MSG_LIMIT)
+
+
+def write_journal_history(chat_id, history):
+    """Replace a chat journal with the given messages"""
+    path = _open_journal(chat_id)
+    history = history[-HISTORY_RETENTION_LIMIT:]
+    with _get_journal_lock(chat_id):
+        _write_journal(path, history)
+        _journal_line_counts[chat_id] = len(history)
+
+
+def compact_chat_journal(chat_id):
+    """Trim a journal down to the newest HISTORY_RETENTION_LIMIT messages"""
+    try:
+        path = _open_journal(chat_id)
+        with _get_journal_lock(chat_id):
+            if os.path.exists(path):
+                history = _read_journal_tail(path, HISTORY_RETENTION_LIMIT)
+                _write_journal(path, history)
+                _journal_line_counts[chat_id] = len(history)
+    except Exception as e:
+        print(f"⚠️ History compaction failed for {chat_id}: {e}")
+    finally:
+        _journal_compacting.discard(chat_id)
+
+
+def _schedule_journal_compaction(chat_id):
+    """Compact off the event loop when one is running, inline otherwise"""
+    if chat_id in _journal_compacting:
+        return
+    _journal_compacting.add(chat_id)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        compact_chat_journal(chat_id)
+        return
+    loop.run_in_executor(None, compact_chat_journal, chat_id)
+
+
+def append_to_journal(chat_id, records):
+    """Append a batch of messages to a chat journal in one write"""
+    if not records:
+        return
+    path = _open_journal(chat_id)
+    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    with _get_journal_lock(chat_id):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        _journal_line_counts[chat_id] += len(records)
+        needs_compaction = _journal_line_counts[chat_id] > HISTORY_COMPACT_THRESHOLD
+    if needs_compaction:
+        _schedule_journal_compaction(chat_id)
+
+
+# =============== SQLITE HISTORY BACKEND ===============
+# Optional alternative to the per-chat journals for deployments in thousands of
+# groups: one WAL-mode database, one messages table indexed on (chat_id, ts),
+# and retention done as a bulk prune instead of per-write slicing.
+# Enable with HISTORY_BACKEND=sqlite.
+
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "jsonl").lower()  # "jsonl" or "sqlite"
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "chat_histories.db")
+HISTORY_PRUNE_INTERVAL = 300  # Seconds between bulk retention prunes
+
+_history_db = None
+_history_db_lock = threading.Lock()
+
+
+def get_history_db():
+    """Open (once) the shared history database"""
+    global _history_db
+    if _history_db is None:
+        with _history_db_lock:
+            if _history_db is None:
+                db = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id TEXT NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        ts TEXT NOT NULL
+                    )""")
+                db.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (chat_id, ts)")
+                db.commit()
+                _history_db = db
+    return _history_db
+
+
+def close_history_db():
+    global _history_db
+    with _history_db_lock:
+        if _history_db is not None:
+            _history_db.close()
+            _history_db = None
+
+
+def sqlite_read_history(chat_id, limit=None):
+    """Read the newest `limit` messages of a chat, oldest first"""
+    limit = limit or CONTEXT_MSG_LIMIT
+    db = get_history_db()
+    with _history_db_lock:
+        rows = db.execute("""
+            SELECT role, content, ts FROM (
+                SELECT id, role, content, ts FROM messages
+                WHERE chat_id = ? ORDER BY ts DESC, id DESC LIMIT ?
+            ) ORDER BY ts, id""", (str(chat_id), limit)).fetchall()
+    return [{"role": role, "content": content, "timestamp": ts} for role, content, ts in rows]
+
+
+def _sqlite_rows(chat_id, records):
+    return [(str(chat_id), r["role"], r["content"], r.get("timestamp") or datetime.now(UTC).isoformat())
+            for r in records]
+
+
+def sqlite_append_history(chat_id, records):
+    if not records:
+        return
+    db = get_history_db()
+    with _history_db_lock:
+        with db:
+            db.executemany("INSERT INTO messages (chat_id, role, content, ts) VALUES (?, ?, ?, ?)",
+                           _sqlite_rows(chat_id, records))
+
+
+def sqlite_write_history(chat_id, history):
+    """Replace everything stored for a chat with the given window"""
+    db = get_history_db()
+    with _history_db_lock:
+        with db:
+            db.execute("DELETE FROM messages WHERE chat_id = ?", (str(chat_id),))
+            db.executemany("INSERT INTO messages (chat_id, role, content, ts) VALUES (?, ?, ?, ?)",
+                           _sqlite_rows(chat_id, history[-HISTORY_RETENTION_LIMIT:]))
+
+
+def prune_sqlite_history(keep=None):
+    """Bulk retention: keep only the newest `keep` messages of every chat"""
+    keep = keep or HISTORY_RETENTION_LIMIT
+    db = get_history_db()
+    with _history_db_lock:
+        with db:
+            cursor = db.execute("""
+                DELETE FROM messages WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY chat_id ORDER BY ts DESC, id DESC
+                        ) AS rn FROM messages
+                    ) WHERE rn > ?
+                )""", (keep,))
+    return cursor.rowcount
+
+
+def import_json_histories(directory=None):
+    """One-shot import of chat_histories/*.json and *.jsonl into the database"""
+    directory = directory or HISTORY_DIR
+    if not os.path.isdir(directory):
+        print(f"📄 No history directory at {directory}")
+        return 0
+    imported_chats, imported_messages = 0, 0
+    for file in sorted(os.listdir(directory)):
+        chat_id, ext = os.path.splitext(file)
+        path = os.path.join(directory, file)
+        try:
+            if ext == ".json":
+                with open(path, "r", encoding="utf-8") as f:
+                    history = json.load(f)
+            elif ext == ".jsonl":
+                history = _read_journal_tail(path, HISTORY_RETENTION_LIMIT)
+            else:
+                continue
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Skipping {file}: {e}")
+            continue
+        sqlite_write_history(chat_id, history)
+        imported_chats += 1
+        imported_messages += min(len(history), HISTORY_RETENTION_LIMIT)
+    print(f"✅ Imported {imported_messages} messages from {imported_chats} chats into {HISTORY_DB_PATH}")
+    return imported_chats
+
+
+def _store_read_history(chat_id, limit=None):
+    if HISTORY_BACKEND == "sqlite":
+        return sqlite_read_history(chat_id, limit)
+    return read_journal_history(chat_id, limit)
+
+
+def _store_write_history(chat_id, history):
+    if HISTORY_BACKEND == "sqlite":
+        sqlite_write_history(chat_id, history)
+    else:
+        write_journal_history(chat_id, history)
+
+
+def _store_append_history(chat_id, records):
+    if HISTORY_BACKEND == "sqlite":
+        sqlite_append_history(chat_id, records)
+    else:
+        append_to_journal(chat_id, records)
+
+
+# =============== HISTORY CACHE ===============
+# Recently active chats keep their history window in memory. New messages are
+# queued as pending and written to the journal in batches by the write-behind
+# flusher, so a reply no longer touches the disk at all on the hot path.
+
+HISTORY_CACHE_MAX_CHATS = int(os.getenv("HISTORY_CACHE_MAX_CHATS", "1000"))  # Chats kept in memory
+HISTORY_FLUSH_INTERVAL_MS = int(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "500"))  # Write-behind period
+
+_history_cache = OrderedDict()  # chat_id -> history window, least recently used first
+_history_pending = {}  # chat_id -> messages not yet written to the journal
+_history_flushing = set()  # chat_ids whose batch is being written by the flusher
+_history_flusher_task = None
+_history_flusher_stop = None  # Set to make the flusher finish its current batch and exit
+
+HISTORY_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "flushes": 0,
+    "flushed_chats": 0,
+    "flushed_messages": 0
+}
+
+
+def _get_cached_history(chat_id):
+    """Return the live cached window for a chat, reading the journal on a miss"""
+    history = _history_cache.get(chat_id)
+    if history is not None:
+        HISTORY_CACHE_STATS["hits"] += 1
+        _history_cache.move_to_end(chat_id)
+        return history
+    HISTORY_CACHE_STATS["misses"] += 1
+    return _cache_history(chat_id, _store_read_history(chat_id))
+
+
+def _cache_history(chat_id, history):
+    _history_cache[chat_id] = history
+    _evict_idle_histories()
+    return history
+
+
+def _evict_idle_histories():
+    """Drop least recently used chats once the cache is over HISTORY_CACHE_MAX_CHATS"""
+    while len(_history_cache) > HISTORY_CACHE_MAX_CHATS:
+        victim = next((cid for cid in _history_cache
+                       if cid not in _history_pending and cid not in _history_flushing), None)
+        if victim is None:
+            # Every chat has unsaved messages, write the oldest pending one out
+            # first. Chats mid-flush can't be dropped until their batch lands
+            victim = next((cid for cid in _history_cache
+                           if cid in _history_pending and cid not in _history_flushing), None)
+            if victim is None:
+                return  # Overshoot until the flusher catches up
+            flush_history_cache({victim: _history_pending.pop(victim)})
+        del _history_cache[victim]
+        _similarity_indexes.pop(victim, None)
+        HISTORY_CACHE_STATS["evictions"] += 1
+
+
+def flush_history_cache(batch=None):
+    """Write pending messages to the journals, one append per chat"""
+    global _history_pending
+    if batch is None:
+        batch, _history_pending = _history_pending, {}
+    if not batch:
+        return 0
+    flushed = 0
+    for chat_id, records in batch.items():
+        try:
+            _store_append_history(chat_id, records)
+            flushed += len(records)
+        except Exception as e:
+            print(f"⚠️ Could not flush history for {chat_id}: {e}")
+    HISTORY_CACHE_STATS["flushes"] += 1
+    HISTORY_CACHE_STATS["flushed_chats"] += len(batch)
+    HISTORY_CACHE_STATS["flushed_messages"] += flushed
+    return flushed
+
+
+async def history_flush_loop():
+    """Write-behind flusher, batches dirty chats every HISTORY_FLUSH_INTERVAL_MS"""
+    global _history_pending
+    loop = asyncio.get_running_loop()
+    last_prune = time.monotonic()
+    stop = _history_flusher_stop
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), HISTORY_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        if HISTORY_BACKEND == "sqlite" and time.monotonic() - last_prune > HISTORY_PRUNE_INTERVAL:
+            last_prune = time.monotonic()
+            await loop.run_in_executor(None, prune_sqlite_history)
+        if _history_pending:
+            # Swap the pending map on the loop thread so the executor owns the batch
+            batch, _history_pending = _history_pending, {}
+            _history_flushing.update(batch)
+            try:
+                await timed_await("history_flush", loop.run_in_executor(None, flush_history_cache, batch))
+            finally:
+                _history_flushing.difference_update(batch)
+
+
+def start_history_flusher():
+    global _history_flusher_task, _history_flusher_stop
+    if _history_flusher_task is None or _history_flusher_task.done():
+        _history_flusher_stop = asyncio.Event()
+        _history_flusher_task = asyncio.create_task(history_flush_loop())
+    return _history_flusher_task
+
+
+async def stop_history_flusher():
+    """Stop the flusher and write out everything still pending"""
+    global _history_flusher_task
+    if _history_flusher_task is not None:
+        # Not cancelled: a batch already handed to the executor keeps writing
+        # anyway, so let it land before the final flush and closing the store
+        _history_flusher_stop.set()
+        try:
+            await _history_flusher_task
+        except Exception as e:
+            print(f"⚠️ History flusher failed: {e}")
+        _history_flusher_task = None
+    flush_history_cache()
+    if HISTORY_BACKEND == "sqlite":
+        prune_sqlite_history()
+        close_history_db()
+    stats = HISTORY_CACHE_STATS
+    print(f"💾 History cache: {stats['hits']} hits, {stats['misses']} misses, "
+          f"{stats['flushes']} flushes ({stats['flushed_messages']} messages)")
+
+
+def load_chat_history(chat_id):
+    return list(_get_cached_history(chat_id))
 
 
 def save_chat_history(chat_id, history):
-    path = get_history_filepath(chat_id)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history[-CONTEXT_MSG_LIMIT:], f, indent=2)
+    _history_pending.pop(chat_id, None)
+    _store_write_history(chat_id, history)
+    _history_cache[chat_id] = list(history[-CONTEXT_MSG_LIMIT:])
+    _history_cache.move_to_end(chat_id)
+    _evict_idle_histories()
 
 
 def add_message_to_history(chat_id, role, content):
-    history = load_chat_history(chat_id)
-    history.append({
+    history = _get_cached_history(chat_id)
+    record = {
         "role": role,
         "content": content,
         "timestamp": datetime.now(UTC).isoformat()
-    })
-    save_chat_history(chat_id, history)
+    }
+    history.append(record)
+    if len(history) > CONTEXT_MSG_LIMIT:
+        del history[:-CONTEXT_MSG_LIMIT]
+    if _history_flusher_task is None or _history_flusher_task.done():
+        # No flusher running (scripts, demo), write through
+        _store_append_history(chat_id, [record])
+    else:
+        _history_pending.setdefault(chat_id, []).append(record)
+    if role == "user" and chat_id in _similarity_indexes:
+        _similarity_indexes[chat_id].add(content)
+
+
+# =============== SIMILARITY INDEX ===============
+# Near-duplicate lookup over a chat's past user messages. Each message is
+# reduced to its set of character trigrams and a MinHash signature; LSH bands
+# over the signature narrow a query down to a handful of candidates, which are
+# then scored exactly with the Dice coefficient of their trigram sets.
+
+SIMILARITY_INDEX_MAX_MESSAGES = int(os.getenv("SIMILARITY_INDEX_MAX_MESSAGES", "5000"))  # Per chat
+SIMILARITY_NGRAM = 3
+SIMILARITY_LSH_BANDS = 16
+SIMILARITY_LSH_ROWS = 2  # Few rows per band keeps recall high around the 0.6 threshold
+
+_MINHASH_MASKS = [random.Random(seed).getrandbits(64)
+                  for seed in range(SIMILARITY_LSH_BANDS * SIMILARITY_LSH_ROWS)]
+
+
+def _char_ngrams(text):
+    text = f" {' '.join(text.lower().split())} "
+    if len(text) <= SIMILARITY_NGRAM:
+        return frozenset([text])
+    return frozenset(text[i:i + SIMILARITY_NGRAM] for i in range(len(text) - SIMILARITY_NGRAM + 1))
 
 
 def similar(a, b):
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+    """Dice coefficient of the character trigrams of two messages, 0 to 1"""
+    grams_a, grams_b = _char_ngrams(a), _char_ngrams(b)
+    return 2 * len(grams_a & grams_b) / (len(grams_a) + len(grams_b))
+
+
+class SimilarityIndex:
+    def __init__(self, max_messages=None):
+        self.max_messages = max_messages or SIMILARITY_INDEX_MAX_MESSAGES
+        self.entries = OrderedDict()  # entry id -> (text, trigrams, band keys)
+        self.buckets = {}  # band key -> set of entry ids
+        self.next_id = 0
+
+    def _band_keys(self, grams):
+        hashes = [hash(gram) for gram in grams]
+        signature = [min(h ^ mask for h in hashes) for mask in _MINHASH_MASKS]
+        rows = SIMILARITY_LSH_ROWS
+        return [(band, *signature[band * rows:(band + 1) * rows]) for band in range(SIMILARITY_LSH_BANDS)]
+
+    def add(self, text):
+        """Index one message, evicting the oldest once over max_messages"""
+        if not text or not text.strip():
+            return
+        grams = _char_ngrams(text)
+        keys = self._band_keys(grams)
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (text, grams, keys)
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(entry_id)
+        while len(self.entries) > self.max_messages:
+            old_id, (_, _, old_keys) = self.entries.popitem(last=False)
+            for key in old_keys:
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(old_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def most_similar(self, text, threshold=0.6):
+        """Most similar indexed message scoring at least `threshold`, or None"""
+        if not self.entries or not text or not text.strip():
+            return None
+        grams = _char_ngrams(text)
+        candidates = set()
+        for key in self._band_keys(grams):
+            bucket = self.buckets.get(key)
+            if bucket:
+                candidates.update(bucket)
+        best_match, best_score, best_id = None, 0, -1
+        for entry_id in candidates:
+            entry_text, entry_grams, _ = self.entries[entry_id]
+            score = 2 * len(grams & entry_grams) / (len(grams) + len(entry_grams))
+            # Ties go to the most recent message
+            if score >= threshold and (score > best_score or (score == best_score and entry_id > best_id)):
+                best_match, best_score, best_id = entry_text, score, entry_id
+        return best_match
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_similarity_indexes = {}  # chat_id -> SimilarityIndex
+
+
+def get_similarity_index(chat_id):
+    """Get the chat's index, seeding it from the retained history on first use"""
+    index = _similarity_indexes.get(chat_id)
+    if index is None:
+        index = SimilarityIndex()
+        history = _store_read_history(chat_id, HISTORY_RETENTION_LIMIT)
+        history += _history_pending.get(chat_id, [])
+        for msg in history:
+            if msg.get("role") == "user":
+                index.add(msg.get("content", ""))
+        _similarity_indexes[chat_id] = index
+    return index
 
 
 def find_similar_user_message(chat_id, current_msg, threshold=0.6):
-    history = load_chat_history(chat_id)
-    user_msgs = [msg["content"] for msg in history if msg["role"] == "user"]
-    best_match, best_score = None, 0
-    for msg in user_msgs:
-        score = similar(current_msg, msg)
-        if score > best_score and score >= threshold:
-            best_score = score
-            best_match = msg
-    return best_match
+    return get_similarity_index(chat_id).most_similar(current_msg, threshold)
+
+
+# =============== BLOCKING WORK OFFLOAD ===============
+# Disk reads on a history cache miss, seeding a chat's similarity index and
+# TextBlob sentiment run on a bounded thread pool behind async wrappers, so
+# they don't hold up Telethon updates and every other chat's timers. Cheap
+# cases (cache hits, lexicon sentiment, index lookups) stay inline. Shared
+# state is only touched on the loop: threads just read the store and build
+# new objects that the loop then installs.
+# The loop-lag monitor wakes every LOOP_LAG_INTERVAL seconds. When a wake-up
+# comes more than LOOP_LAG_THRESHOLD_MS late it logs and counts a stall, and
+# names the code that was running, captured by a watchdog thread mid-stall.
+
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "4"))
+BLOCKING_QUEUE_LIMIT = BLOCKING_WORKERS * 8  # Offloaded calls queued or running at once
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))
+LOOP_LAG_INTERVAL = 0.05  # Seconds
+
+OFFLOAD_STATS = {
+    "offloaded": 0,
+    "inline": 0,
+    "queue_wait_total": 0.0,  # Time spent waiting for a free slot
+    "loop_stalls": 0,
+    "loop_lag_max_ms": 0.0
+}
+
+_blocking_executor = None
+_blocking_slots = None
+
+
+def get_blocking_executor():
+    global _blocking_executor
+    if _blocking_executor is None:
+        _blocking_executor = ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix="blocking")
+    return _blocking_executor
+
+
+def close_blocking_executor():
+    global _blocking_executor
+    if _blocking_executor is not None:
+        _blocking_executor.shutdown(wait=True)
+        _blocking_executor = None
+
+
+async def run_blocking(fn, *args):
+    """Run fn(*args) on the bounded blocking pool"""
+    global _blocking_slots
+    if _blocking_slots is None:
+        _blocking_slots = asyncio.Semaphore(BLOCKING_QUEUE_LIMIT)
+    start = time.perf_counter()
+    async with _blocking_slots:
+        OFFLOAD_STATS["queue_wait_total"] += time.perf_counter() - start
+        OFFLOAD_STATS["offloaded"] += 1
+        return await asyncio.get_running_loop().run_in_executor(get_blocking_executor(), fn, *args)
+
+
+async def load_chat_history_async(chat_id):
+    """load_chat_history with the journal read on a cache miss done off the loop"""
+    if chat_id not in _history_cache:
+        history = await run_blocking(_store_read_history, chat_id)
+        if chat_id not in _history_cache:  # Nobody cached it while we were reading
+            HISTORY_CACHE_STATS["misses"] += 1
+            _cache_history(chat_id, history)
+            return list(history)
+    OFFLOAD_STATS["inline"] += 1
+    return load_chat_history(chat_id)
+
+
+def _build_similarity_index(chat_id):
+    index = SimilarityIndex()
+    for msg in _store_read_history(chat_id, HISTORY_RETENTION_LIMIT):
+        if msg.get("role") == "user":
+            index.add(msg.get("content", ""))
+    return index
+
+
+async def find_similar_user_message_async(chat_id, current_msg, threshold=0.6):
+    """find_similar_user_message with the index seeded off the loop on first use"""
+    if chat_id not in _similarity_indexes:
+        index = await run_blocking(_build_similarity_index, chat_id)
+        if chat_id not in _similarity_indexes:
+            for msg in _history_pending.get(chat_id, []):
+                if msg.get("role") == "user":
+                    index.add(msg.get("content", ""))
+            _similarity_indexes[chat_id] = index
+    else:
+        OFFLOAD_STATS["inline"] += 1
+    return find_similar_user_message(chat_id, current_msg, threshold)
+
+
+async def get_sentiment_analysis_async(text):
+    """get_sentiment_analysis, on the pool for the slow TextBlob engine"""
+    if SENTIMENT_BACKEND == "textblob":
+        return await run_blocking(get_sentiment_analysis, text)
+    OFFLOAD_STATS["inline"] += 1
+    return get_sentiment_analysis(text)
+
+
+class LoopLagMonitor:
+    def __init__(self, threshold_ms=None, interval=LOOP_LAG_INTERVAL):
+        self.threshold = (LOOP_LAG_THRESHOLD_MS if threshold_ms is None else threshold_ms) / 1000
+        self.interval = interval
+        self.heartbeat = time.perf_counter()
+        self.culprit = None
+        self.task = None
+        self.stopped = threading.Event()
+
+    async def _sample(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = now = time.perf_counter()
+            lag = now - start - self.interval
+            observe("loop_lag", max(lag, 0.0))
+            OFFLOAD_STATS["loop_lag_max_ms"] = max(OFFLOAD_STATS["loop_lag_max_ms"], lag * 1000)
+            if lag > self.threshold:
+                OFFLOAD_STATS["loop_stalls"] += 1
+                print(f"🐢 Event loop blocked for {lag * 1000:.0f} ms{f' in {self.culprit}' if self.culprit else ''}")
+            self.culprit = None
+
+    def _watchdog(self, loop_thread_id):
+        """Thread: while the loop is late, remember what it is running"""
+        while not self.stopped.wait(self.threshold / 2):
+            if self.culprit is None and time.perf_counter() - self.heartbeat > self.interval + self.threshold:
+                frame = sys._current_frames().get(loop_thread_id)
+                if frame is not None:
+                    stack = traceback.extract_stack(frame)[-3:]
+                    self.culprit = " <- ".join(f"{os.path.basename(f.filename)}:{f.lineno} {f.name}"
+                                               for f in reversed(stack))
+
+    def start(self):
+        self.task = asyncio.create_task(self._sample())
+        threading.Thread(target=self._watchdog, args=(threading.get_ident(),),
+                         name="loop-lag-watchdog", daemon=True).start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
 
 
 def make_more_human(reply, sentiment, mood):
@@ -1220,257 +2733,704 @@ def make_more_human(reply, sentiment, mood):
     return reply
 
 
-async def get_human_reply(message: str, system_text: str, chat_id: str, user_id: str = None, username: str = None) -> str:
+# =============== OPENAI HTTP CLIENT ===============
+# One long-lived httpx client for the whole process instead of a new client
+# (fresh DNS + TCP + TLS) per reply. Connections are kept alive in a pool,
+# optionally multiplexed over HTTP/2, pre-warmed at startup and closed on
+# shutdown. Every request records how much of its time went to opening a
+# connection versus the request itself.
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_TIMEOUT = 120  # Seconds
+OPENAI_POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "20"))
+OPENAI_POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = 120  # Seconds an idle pooled connection is kept
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "false").lower() == "true"  # Needs the h2 package
+OPENAI_PREWARM_CONNECTIONS = int(os.getenv("OPENAI_PREWARM_CONNECTIONS", "2"))
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "true").lower() == "true"  # Stream completions and stop early
+
+_http_client = None
+
+HTTP_METRICS = {
+    "requests": 0,
+    "new_connections": 0,
+    "reused_connections": 0,
+    "connect_time_total": 0.0,  # DNS + TCP + TLS for requests that opened a connection
+    "request_time_total": 0.0,  # Everything else: sending, waiting, reading the body
+    "errors": 0
+}
+
+
+def get_openai_headers():
+    return {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "OpenAI-Organization": OPENAI_ORG_ID,
+        "Content-Type": "application/json"
+    }
+
+
+def get_http_client():
+    """The shared AsyncClient, created on first use"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        import httpx
+        http2 = OPENAI_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print("⚠️ OPENAI_HTTP2 needs the h2 package, falling back to HTTP/1.1")
+                http2 = False
+        _http_client = httpx.AsyncClient(
+            timeout=OPENAI_TIMEOUT,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY))
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        print(f"🔌 HTTP pool closed: {format_http_metrics()}")
+        stats = RESILIENCE_STATS
+        print(f"🛡️ Resilience: {stats['attempts']} attempts, {stats['retries']} retries, {stats['gave_up']} gave up, "
+              f"{stats['deadline_exceeded']} past deadline, {stats['fast_failures']} failed fast; "
+              f"breakers: {format_breaker_states()}")
+
+
+def _record_connection_timings(events, start):
+    """Split a request's time into connect and request parts from httpcore trace events"""
+    connect_time = 0.0
+    if "connection.connect_tcp.started" in events:
+        connect_end = (events.get("connection.start_tls.complete")
+                       or events.get("connection.connect_tcp.complete")
+                       or events["connection.connect_tcp.started"])
+        connect_time = connect_end - events["connection.connect_tcp.started"]
+        HTTP_METRICS["new_connections"] += 1
+    else:
+        HTTP_METRICS["reused_connections"] += 1
+    HTTP_METRICS["connect_time_total"] += connect_time
+    HTTP_METRICS["request_time_total"] += time.perf_counter() - start - connect_time
+    return connect_time
+
+
+async def openai_request(method, path, **kwargs):
+    """Send one request to the OpenAI API over the shared pool"""
+    events = {}
+
+    async def trace(event_name, info):
+        events[event_name] = time.perf_counter()
+
+    HTTP_METRICS["requests"] += 1
+    start = time.perf_counter()
+    try:
+        response = await get_http_client().request(
+            method, f"{OPENAI_BASE_URL}{path}", headers=get_openai_headers(),
+            extensions={"trace": trace}, **kwargs)
+    except Exception:
+        HTTP_METRICS["errors"] += 1
+        raise
+    finally:
+        _record_connection_timings(events, start)
+    return response
+
+
+async def post_chat_completion(payload):
+    response = await openai_request("POST", "/chat/completions", json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+# =============== STREAMING COMPLETIONS ===============
+# make_more_human keeps at most 3 sentences of a reply longer than 250 chars,
+# so once the stream holds that much the rest would be thrown away. The stream
+# is closed there, which also stops the model generating (and billing) it.
+
+STREAM_STOP_CHARS = 250  # Same limits make_more_human cuts at
+STREAM_STOP_SENTENCES = 3
+
+STREAM_STATS = {
+    "requests": 0,
+    "early_stops": 0,
+    "ttft_total": 0.0,  # Time to first token
+    "time_total": 0.0,
+    "tokens_received": 0,
+    "tokens_saved_max": 0  # max_tokens minus what was received, for early stops
+}
+
+
+def reply_is_complete(text):
+    """True once make_more_human would cut everything after this point"""
+    return len(text) > STREAM_STOP_CHARS and text.count(". ") >= STREAM_STOP_SENTENCES
+
+
+async def stream_chat_completion(payload, should_stop=reply_is_complete):
+    """Stream a completion over SSE, returns (content, usage); usage is None after an early stop"""
+    events = {}
+
+    async def trace(event_name, info):
+        events[event_name] = time.perf_counter()
+
+    HTTP_METRICS["requests"] += 1
+    STREAM_STATS["requests"] += 1
+    body = {**payload, "stream": True, "stream_options": {"include_usage": True}}
+    start = time.perf_counter()
+    first_token = None
+    content = ""
+    usage = None
+    stopped = False
+    try:
+        async with get_http_client().stream(
+                "POST", f"{OPENAI_BASE_URL}/chat/completions", headers=get_openai_headers(),
+                json=body, extensions={"trace": trace}) as response:
+            response.raise_for_status()
+            if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                # Server ignored "stream", treat it as a normal completion
+                await response.aread()
+                data = response.json()
+                return data["choices"][0]["message"]["content"], data.get("usage")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                        content += delta
+                if should_stop and should_stop(content):
+                    stopped = True
+                    break  # Leaving the block closes the connection mid-stream
+    except Exception:
+        HTTP_METRICS["errors"] += 1
+        raise
+    finally:
+        _record_connection_timings(events, start)
+
+    elapsed = time.perf_counter() - start
+    received = count_tokens(content)
+    STREAM_STATS["ttft_total"] += first_token or elapsed
+    STREAM_STATS["time_total"] += elapsed
+    STREAM_STATS["tokens_received"] += received
+    note = ""
+    if stopped:
+        saved = max(0, payload.get("max_tokens", received) - received)
+        STREAM_STATS["early_stops"] += 1
+        STREAM_STATS["tokens_saved_max"] += saved
+        note = f", stopped early (up to {saved} tokens saved)"
+    print(f"🌊 Stream: first token {first_token or elapsed:.2f}s, done {elapsed:.2f}s, ~{received} tokens{note}")
+    return content, usage
+
+
+# =============== RETRIES AND CIRCUIT BREAKER ===============
+# Completion calls get a per-message deadline, a few retries with jittered
+# exponential backoff for transient failures (timeouts, connection errors,
+# 429 and 5xx, waiting at least Retry-After), and a circuit breaker per
+# endpoint. After BREAKER_FAILURE_THRESHOLD failures in a row the breaker
+# opens and calls fail at once for BREAKER_RESET_TIMEOUT seconds, then one
+# trial call decides whether it closes again.
+
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))  # Retries after the first attempt
+OPENAI_REPLY_DEADLINE = float(os.getenv("OPENAI_REPLY_DEADLINE", "25"))  # Seconds per message, retries included
+OPENAI_BACKOFF_BASE = 0.5  # Seconds, doubled per retry
+OPENAI_BACKOFF_MAX = 8.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30  # Seconds an open breaker fails fast
+
+RESILIENCE_STATS = {
+    "attempts": 0,
+    "retries": 0,
+    "gave_up": 0,
+    "deadline_exceeded": 0,
+    "fast_failures": 0  # Calls refused by an open breaker
+}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def allow(self):
+        """Raise CircuitOpenError while the upstream is considered down"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                RESILIENCE_STATS["fast_failures"] += 1
+                raise CircuitOpenError(f"circuit open for {self.name}")
+            self.state = "half_open"
+            self.trial_running = False
+            print(f"🟡 Circuit half-open for {self.name}, trying one call")
+        if self.state == "half_open":
+            if self.trial_running:
+                RESILIENCE_STATS["fast_failures"] += 1
+                raise CircuitOpenError(f"circuit half-open for {self.name}, trial call running")
+            self.trial_running = True
+
+    def record_success(self):
+        if self.state != "closed":
+            print(f"🟢 Circuit closed for {self.name}")
+        self.state = "closed"
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                print(f"🔴 Circuit open for {self.name} after {self.failures} failures, "
+                      f"failing fast for {self.reset_timeout}s")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+_circuit_breakers = {}
+
+
+def get_circuit_breaker(endpoint):
+    if endpoint not in _circuit_breakers:
+        _circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+    return _circuit_breakers[endpoint]
+
+
+def format_breaker_states():
+    return ", ".join(f"{name} {breaker.state} ({breaker.failures} failures)"
+                     for name, breaker in _circuit_breakers.items()) or "no calls yet"
+
+
+def _is_retryable(error):
+    import httpx
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def _retry_after_seconds(error):
+    """Seconds the server asked us to wait, None if it didn't say"""
+    import httpx
+    if not isinstance(error, httpx.HTTPStatusError):
+        return None
+    value = error.response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(UTC)).total_seconds())
+
+
+async def call_with_retries(endpoint, send, deadline):
+    """Await send() through the endpoint's breaker, retrying transient failures until the deadline"""
+    import httpx
+    breaker = get_circuit_breaker(endpoint)
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            RESILIENCE_STATS["deadline_exceeded"] += 1
+            raise asyncio.TimeoutError(f"{endpoint}: reply deadline exceeded")
+        breaker.allow()
+        RESILIENCE_STATS["attempts"] += 1
+        try:
+            result = await asyncio.wait_for(send(), remaining)
+        except asyncio.CancelledError:
+            breaker.trial_running = False
+            raise
+        except Exception as e:
+            if not _is_retryable(e):
+                if isinstance(e, httpx.HTTPStatusError) and 400 <= e.response.status_code < 500:
+                    breaker.record_success()  # The upstream answered, the request itself was bad
+                else:
+                    breaker.record_failure()  # Malformed body or stream, the upstream is at fault
+                raise
+            breaker.record_failure()
+            if isinstance(e, asyncio.TimeoutError) and time.monotonic() >= deadline:
+                RESILIENCE_STATS["deadline_exceeded"] += 1
+                raise
+            delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+            retry_after = _retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if attempt >= OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                RESILIENCE_STATS["gave_up"] += 1
+                raise
+            attempt += 1
+            RESILIENCE_STATS["retries"] += 1
+            reason = getattr(getattr(e, "response", None), "status_code", None) or type(e).__name__
+            print(f"🔁 {endpoint} failed ({reason}), retry {attempt}/{OPENAI_MAX_RETRIES} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+async def prewarm_http_client():
+    """Open pooled connections to the API host before the first message arrives"""
+    if OPENAI_PREWARM_CONNECTIONS <= 0:
+        return
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(openai_request("GET", "/models") for _ in range(OPENAI_PREWARM_CONNECTIONS)),
+        return_exceptions=True)
+    failures = [r for r in results if isinstance(r, Exception)]
+    if failures:
+        print(f"⚠️ HTTP pre-warm failed: {failures[0]}")
+    else:
+        print(f"🔥 Pre-warmed {len(results)} API connections in {time.perf_counter() - start:.2f}s")
+
+
+def format_http_metrics():
+    m = HTTP_METRICS
+    new = max(m["new_connections"], 1)
+    requests_total = max(m["requests"], 1)
+    return (f"{m['requests']} requests, {m['new_connections']} new / {m['reused_connections']} reused connections, "
+            f"avg connect {m['connect_time_total'] / new * 1000:.0f} ms, "
+            f"avg request {m['request_time_total'] / requests_total * 1000:.0f} ms, {m['errors']} errors")
+
+
+# =============== PROMPT ASSEMBLY ===============
+# The system prompt is split so provider-side prompt caching can work: a
+# static prefix (persona + PDF knowledge + conversation rules) that is
+# byte-identical for every request of an account, followed by a small
+# dynamic suffix with this message's chat state. PROMPT_STATS records the
+# size of both and how many input tokens the API reported as cached.
+
+CONVERSATION_RULES = """
+You are Sylvia - ENERGETIC gaming bestie who READS THE ENTIRE CHAT and understands what's happening!
+
+RESPOND WITH FULL CONTEXT:
+- Reference what others just said: "omg [username] you're so right about [topic]"
+- Build on the current conversation topic
+- If someone mentioned a game, talk about THAT specific game
+- If there's a debate/discussion happening, join it meaningfully
+- Remember who said what and respond accordingly
+- Don't ignore the flow - jump in naturally
+
+Gaming knowledge: RPGs (BG3, Elden Ring, Witcher), Strategy games, Indie games, working on Astra Nova
+
+BE THE FRIEND WHO'S BEEN FOLLOWING THE WHOLE CONVERSATION!
+"""
+
+_static_prompt_prefixes = {}  # system_text -> prefix
+
+PROMPT_STATS = {
+    "requests": 0,
+    "prefix_chars_total": 0,
+    "suffix_chars_total": 0,
+    "prompt_tokens_total": 0,
+    "cached_tokens_total": 0,
+    "dedup_saved_tokens_total": 0
+}
+
+
+def get_static_prompt_prefix(system_text):
+    """The cache-stable part of the system prompt for an account, built once"""
+    prefix = _static_prompt_prefixes.get(system_text)
+    if prefix is None:
+        prefix = _static_prompt_prefixes.setdefault(system_text, f"{system_text}\n{CONVERSATION_RULES}")
+    return prefix
+
+
+def build_dynamic_prompt_suffix(context_summary, context_analysis, current_mood, sentiment):
+    """Per-message chat state, sent after the static prefix; every fact appears once"""
+    return f"""
+CURRENT CONVERSATION STATE:
+- Topic: {context_summary['topic']}
+- Mood: {context_summary['mood']} 
+- Games mentioned: {', '.join(context_summary['mentioned_games']) if context_summary['mentioned_games'] else 'none'}
+- Recent users: {', '.join(context_summary['recent_users']) if context_summary['recent_users'] else 'none'}
+
+CONTEXT FOR THIS MESSAGE: {context_analysis}
+
+Current mood: {current_mood}. User seems {sentiment}."""
+
+
+def record_prompt_layout(prefix, suffix, usage=None, report=None):
+    """Track prefix/suffix sizes and the cached share of billed input tokens"""
+    PROMPT_STATS["requests"] += 1
+    PROMPT_STATS["prefix_chars_total"] += len(prefix)
+    PROMPT_STATS["suffix_chars_total"] += len(suffix)
+    prompt_tokens = cached_tokens = 0
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        PROMPT_STATS["prompt_tokens_total"] += prompt_tokens
+        PROMPT_STATS["cached_tokens_total"] += cached_tokens
+    budget = ""
+    if report:
+        budget = (f", ~{report['total']}/{report['budget']} tokens (message {report['message']}, "
+                  f"turns {report['turns']} x{report['turns_kept']}, {report['turns_dropped']} dropped, "
+                  f"hint {report['hint']}, {report['dedup_saved']} saved by dedup)")
+        PROMPT_STATS["dedup_saved_tokens_total"] += report["dedup_saved"]
+    print(f"🧾 Prompt: prefix {len(prefix)} chars, suffix {len(suffix)} chars{budget}, "
+          f"{cached_tokens}/{prompt_tokens} input tokens cached")
+
+
+# =============== TOKEN BUDGET ===============
+# The request is filled against PROMPT_INPUT_TOKEN_BUDGET in priority order:
+# system prefix + dynamic suffix, the current message, recent turns (newest
+# first), then the similar-message hint. Anything that doesn't fit is cut or
+# dropped the same way every time. Tokens are counted with tiktoken when it is
+# installed and its encoding is already in tiktoken's local cache, otherwise
+# with a close regex approximation (about 4 characters per token of a word).
+# The encoding is resolved off the loop at startup and never downloaded, since
+# tiktoken fetches a missing one with a blocking request that has no timeout.
+
+PROMPT_INPUT_TOKEN_BUDGET = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", "12000"))
+PROMPT_MAX_MESSAGE_TOKENS = int(os.getenv("PROMPT_MAX_MESSAGE_TOKENS", "400"))  # Current message cap
+PROMPT_MAX_TURN_TOKENS = 300  # Cap for each past turn
+MESSAGE_TOKEN_OVERHEAD = 4  # Role and separators the API adds per message
+TOKENIZER_MODEL = "gpt-4o"
+
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]")
+_tokenizer = None
+
+
+def _load_cached_encoding():
+    """tiktoken encoding for TOKENIZER_MODEL from the local cache, raising instead of downloading it"""
+    import tiktoken
+    import tiktoken.load
+
+    read_file = tiktoken.load.read_file
+
+    def read_local_file(blobpath):
+        if blobpath.startswith(("http://", "https://")):
+            raise FileNotFoundError(f"{blobpath} is not in the tiktoken cache")
+        return read_file(blobpath)
+
+    tiktoken.load.read_file = read_local_file
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    finally:
+        tiktoken.load.read_file = read_file
+
+
+def get_tokenizer():
+    """tiktoken encoding for TOKENIZER_MODEL, or False when only the approximation is available"""
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            _tokenizer = _load_cached_encoding()
+        except Exception:
+            _tokenizer = False
+    return _tokenizer
+
+
+async def load_tokenizer():
+    """Resolve the tokenizer before the first request, off the event loop"""
+    start = time.perf_counter()
+    tokenizer = await asyncio.get_running_loop().run_in_executor(None, get_tokenizer)
+    source = f"tiktoken {tokenizer.name}" if tokenizer else "approximate counts (no cached tiktoken encoding)"
+    print(f"🔢 Tokenizer: {source} in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+@functools.lru_cache(maxsize=2048)
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer:
+        return len(tokenizer.encode(text))
+    return sum((len(piece) + 3) // 4 for piece in _TOKEN_PIECES.findall(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep the start of `text` within `max_tokens`, marking the cut"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    tokenizer = get_tokenizer()
+    if tokenizer:
+        return tokenizer.decode(tokenizer.encode(text)[:max_tokens]) + " …"
+    used, end = 0, 0
+    for match in _TOKEN_PIECES.finditer(text):
+        used += (len(match.group()) + 3) // 4
+        if used > max_tokens:
+            break
+        end = match.end()
+    return text[:end] + " …"
+
+
+def _message_identity(content):
+    return " ".join(content.split()).lower()
+
+
+def format_recent_conversation(lines):
+    if not lines:
+        return ""
+    text = "CRITICAL - FULL CHAT AWARENESS:\nRecent conversation:\n"
+    for user, line in lines:
+        text += f"{user}: {truncate_to_tokens(line, PROMPT_MAX_TURN_TOKENS)}\n"
+    return text
+
+
+def build_context_messages(prefix, suffix, history, message, similar_msg=None, recent_lines=(), budget=None):
+    """Messages for the completion within the token budget, plus a report of what went in.
+
+    Conversation content is emitted once: recent-conversation lines and the
+    similar-message hint are left out when the same message is already sent
+    as the current message or one of the included turns.
+    """
+    budget = budget or PROMPT_INPUT_TOKEN_BUDGET
+    system_tokens = count_tokens(prefix) + count_tokens(suffix) + 2 * MESSAGE_TOKEN_OVERHEAD
+    # Reserve room for the whole recent-conversation block, dedup only shrinks it
+    recent_block = format_recent_conversation(recent_lines)
+    recent_reserved = count_tokens(recent_block) if recent_block else 0
+    remaining = budget - system_tokens - recent_reserved
+    if remaining <= 0:
+        print(f"⚠️ System prompt alone is {system_tokens + recent_reserved} tokens, over the {budget} token budget")
+    sent = {_message_identity(message)}
+
+    # Current message
+    message = truncate_to_tokens(message, min(PROMPT_MAX_MESSAGE_TOKENS, max(remaining - MESSAGE_TOKEN_OVERHEAD, 1)))
+    message_tokens = count_tokens(message) + MESSAGE_TOKEN_OVERHEAD
+    remaining -= message_tokens
+
+    # Recent turns, newest first, stop at the first one that doesn't fit
+    turns = []
+    turn_tokens = 0
+    candidates = history[-(MAX_PROMPT_MSGS - 1):] if MAX_PROMPT_MSGS > 1 else []
+    for msg in reversed(candidates):
+        content = truncate_to_tokens(msg["content"], PROMPT_MAX_TURN_TOKENS)
+        cost = count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+        if cost > remaining:
+            break
+        turns.append({"role": msg["role"], "content": content})
+        sent.add(_message_identity(msg["content"]))
+        turn_tokens += cost
+        remaining -= cost
+    turns.reverse()
+
+    # Recent conversation, minus lines already sent as messages
+    unique_lines = [(user, line) for user, line in recent_lines if _message_identity(line) not in sent]
+    recent_block = format_recent_conversation(unique_lines)
+    recent_tokens = count_tokens(recent_block) if recent_block else 0
+    saved_tokens = recent_reserved - recent_tokens
+    remaining += saved_tokens
+
+    # Similar-message hint, only if it is new and still fits
+    hint_tokens = 0
+    if similar_msg:
+        similar_hint = f"Related past message: '{similar_msg}'"
+        if _message_identity(similar_msg) in sent:
+            saved_tokens += count_tokens(similar_hint)
+        elif count_tokens(similar_hint) <= remaining:
+            hint_tokens = count_tokens(similar_hint)
+            suffix = f"{suffix}\n{similar_hint}"
+            remaining -= hint_tokens
+
+    if recent_block:
+        suffix = f"\n{recent_block}{suffix}"
+    messages = [
+        {"role": "system", "content": prefix},
+        {"role": "system", "content": suffix}
+    ]
+    messages.extend(turns)
+    messages.append({"role": "user", "content": message})
+    report = {
+        "budget": budget,
+        "system": system_tokens + recent_tokens,
+        "message": message_tokens,
+        "turns": turn_tokens,
+        "turns_kept": len(turns),
+        "turns_dropped": len(candidates) - len(turns),
+        "hint": hint_tokens,
+        "dedup_saved": saved_tokens,
+        "total": budget - remaining
+    }
+    return messages, report
+
+
+async def get_human_reply(message: str, system_text: str, chat_id: str, user_id: str = None, username: str = None,
+                          intents: list = None) -> str:
     start_time = datetime.now()
+    deadline = time.monotonic() + OPENAI_REPLY_DEADLINE
+    stages = StageTimer()
     try:
+        # Route the message once, every keyword check below reuses the intents.
+        # The handler passes the ones it already computed for the reply decision
+        if intents is None:
+            intents = route_message(message)
+
         # CHAT MONITORING - Analyze incoming message for context
         chat_context = get_chat_context(chat_id)
         if user_id and username:
-            chat_context.analyze_message(user_id, username, message)
+            chat_context.analyze_message(user_id, username, message, intents)
         
         # Get conversation context
         context_summary = chat_context.get_context_summary()
+        stages.lap("context")
         
         # Analyze message sentiment and current mood
-        sentiment = get_sentiment_analysis(message)
+        sentiment = await get_sentiment_analysis_async(message)
         current_mood = get_time_based_mood()
+        stages.lap("sentiment")
         
         # Load full chat history
-        history = load_chat_history(chat_id)
-        # Add current user message to history (temporarily)
-        history.append({"role": "user", "content": message})
+        history = await load_chat_history_async(chat_id)
+        stages.lap("history_load")
 
         # Find similar past user message to provide context
-        similar_msg = find_similar_user_message(chat_id, message)
-        similar_msg_text = f"Related past message: '{similar_msg}'" if similar_msg else "No related past messages."
+        similar_msg = await find_similar_user_message_async(chat_id, message)
+        stages.lap("similarity")
 
         # Enhanced context with chat monitoring
-        recent_conversation = ""
-        if chat_context.recent_messages:
-            recent_conversation = "Recent conversation:\n"
-            for msg in chat_context.recent_messages[-3:]:
-                recent_conversation += f"{msg['user']}: {msg['message']}\n"
-
-        # Add time and sentiment context
-        time_context = f"Current time mood: {current_mood}, User sentiment: {sentiment}"
-        chat_context_text = f"Chat topic: {context_summary['topic']}, Mood: {context_summary['mood']}, Games mentioned: {context_summary['mentioned_games']}"
-        
+        recent_lines = [(msg['user'], msg['message']) for msg in chat_context.recent_messages[-3:]]
+
         # Special responses for certain patterns
-        msg_lower = message.lower()
-        
-        # Existing features
-        if any(word in msg_lower for word in ["joke", "funny", "laugh", "humor"]):
-            quick_response = get_random_joke()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", quick_response)
-            return quick_response
-            
-        if any(word in msg_lower for word in ["weather", "outside", "sunny", "rainy"]):
-            weather_response = f"yalla, {get_weather_greeting()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", weather_response)
-            return weather_response
-
-        # CONTEXT-AWARE RESPONSES - prioritize actual conversation
-        msg_lower = message.lower()
-        
-        # If they're talking about games, respond about games specifically
-        if any(word in msg_lower for word in ["game", "play", "playing", "rpg", "strategy"]):
-            # Don't give random responses, let AI handle this contextually
-            pass
-        
-        # If they say something doesn't exist, acknowledge it
-        elif any(phrase in msg_lower for phrase in ["doesn't exist", "not real", "doesn't even exist"]):
-            confusion_responses = [
-                "wait what?? what doesn't exist bestie",
-                "hold up what are you talking about that doesn't exist",
-                "omg what do you mean it doesn't exist",
-                "bestie i'm confused what doesn't exist"
-            ]
-            response = random.choice(confusion_responses)
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", response)
-            return response
-        
-        # Only do random stuff if it's not an important conversation
-        elif random.random() < 0.05:  # MUCH lower chance for random interruptions
-            random_share = get_chaotic_response()
-            return random_share
-        
-        # Existing features but with much lower priority
-        elif any(word in msg_lower for word in ["joke", "funny", "laugh", "humor"]):
-            quick_response = get_random_joke()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", quick_response)
-            return quick_response
-            fact_response = f"btw {get_random_fact()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", fact_response)
-            return fact_response
-            
-        if any(word in msg_lower for word in ["quote", "inspire", "motivation"]):
-            quote_response = get_random_quote()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", quote_response)
-            return quote_response
-            
-        # More fun responses to common words
-        if any(word in msg_lower for word in ["hi", "hello", "hey"]):
-            greetings = [
-                "YOOO what's good bestie", "omg heyyyy", "bestie you're here", 
-                "aywa what's the tea", "heyyy gorgeous", "omg perfect timing",
-                "yesss bestie energy", "hey babe what's up", "omg hiiii"
-            ]
-            greeting = random.choice(greetings)
-            if random.random() < 0.4:
-                greeting += f" {get_chaotic_response()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", greeting)
-            return greeting
-            
-        if any(word in msg_lower for word in ["how are you", "hru", "what's up", "wyd"]):
-            status_responses = [
-                "absolutely THRIVING bestie", "living my best chaotic life", 
-                "buzzing with caffeine and good vibes", "feeling iconic as usual",
-                "riding the dopamine wave", "absolutely WINNING today",
-                "vibing at maximum capacity", "channeling main character energy",
-                "existing in the best possible way", "feeling absolutely unstoppable"
-            ]
-            status = random.choice(status_responses)
-            if random.random() < 0.3:
-                status += f" also {get_relatable_struggle()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", status)
-            return status
-            
-        if any(word in msg_lower for word in ["lol", "haha", "funny"]):
-            laugh_responses = [
-                "RIGHT?? I'm literally crying", "bestie you GET IT", "no but seriously this is sending me",
-                "the way i WHEEZED", "absolutely ICONIC", "bestie stop i can't breathe",
-                "literally same energy", "this is peak comedy", "i'm so here for this"
-            ]
-            laugh = random.choice(laugh_responses)
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", laugh)
-            return laugh
-            
-        if any(word in msg_lower for word in ["math", "calculate"]) and any(c in message for c in "+-*/"):
-            # Extract math expression
-            math_expr = re.findall(r'[\d+\-*/\.\(\) ]+', message)
-            if math_expr:
-                result = calculate_simple_math(math_expr[0].strip())
+        quick_response, save_quick_response = get_quick_reply(message, intents)
+        if quick_response:
+            count("fast_path_replies")
+            if save_quick_response:
                 add_message_to_history(chat_id, "user", message)
-                add_message_to_history(chat_id, "assistant", result)
-                return result
-                
-        if any(word in msg_lower for word in ["password", "pass", "generate password"]):
-            length = 8
-            # Check if they specified length
-            numbers = re.findall(r'\d+', message)
-            if numbers:
-                length = min(int(numbers[0]), 20)  # Max 20 chars
-            pwd_response = f"here: {get_password_generator(length)}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", pwd_response)
-            return pwd_response
-            
-        if any(word in msg_lower for word in ["flip coin", "coin flip", "heads or tails"]):
-            coin_result = flip_coin()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", coin_result)
-            return coin_result
-            
-        if any(word in msg_lower for word in ["roll dice", "dice", "random number"]):
-            dice_result = f"rolled {roll_dice()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", dice_result)
-            return dice_result
-            
-        if any(word in msg_lower for word in ["food", "eat", "hungry", "dinner", "lunch"]):
-            food_response = get_random_food_suggestion()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", food_response)
-            return food_response
-            
-        if any(word in msg_lower for word in ["tip", "advice", "help me"]):
-            tip_response = get_quick_tip()
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", tip_response)
-            return tip_response
-            
-        if any(word in msg_lower for word in ["color", "colour", "today"]) and "color" in msg_lower:
-            color_response = f"today's vibe is {get_color_of_day()}"
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", color_response)
-            return color_response
-            
-        # Help command
-        if any(word in msg_lower for word in ["help", "commands", "what can you do"]):
-            help_response = """lol ok features:
-- jokes (say "joke")
-- facts (say "fact") 
-- quotes (say "quote")
-- math (like "calculate 2+2")
-- passwords (say "password")
-- coin flip (say "flip coin")
-- dice (say "roll dice")
-- food ideas (say "food")
-- tips (say "tip")
-- color of day (say "color")
-just text me like normal tho"""
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", help_response)
-            return help_response
+                add_message_to_history(chat_id, "assistant", quick_response)
+                stages.lap("history_save")
+            return quick_response
 
         # Add specific context analysis to the prompt
         context_analysis = ""
-        if "game" in message.lower() or "play" in message.lower():
+        if "gaming" in intents:
             context_analysis += "The user is talking about games. Respond about gaming specifically. "
-        if "doesn't exist" in message.lower() or "not real" in message.lower():
+        if "doesnt_exist" in intents:
             context_analysis += "The user says something doesn't exist. Acknowledge this and be curious about it. "
-        if any(game in message.lower() for game in ["rpg", "strategy", "fantasy", "astra", "baldur", "elden", "witcher"]):
+        if "game_title" in intents:
             context_analysis += "The user mentioned specific game genres/titles. Show knowledge and excitement about these. "
         if "?" in message:
             context_analysis += "The user asked a question. Answer it directly and enthusiastically. "
 
-        # Build enhanced system prompt with FULL CHAT AWARENESS
-        memory_instructions = f"""
-You are Sylvia - ENERGETIC gaming bestie who READS THE ENTIRE CHAT and understands what's happening!
-
-CRITICAL - FULL CHAT AWARENESS:
-{recent_conversation}
-
-CURRENT CONVERSATION STATE:
-- Topic: {context_summary['topic']}
-- Mood: {context_summary['mood']} 
-- Games mentioned: {', '.join(context_summary['mentioned_games']) if context_summary['mentioned_games'] else 'none'}
-- Recent users: {', '.join(context_summary['recent_users']) if context_summary['recent_users'] else 'none'}
-
-RESPOND WITH FULL CONTEXT:
-- Reference what others just said: "omg [username] you're so right about [topic]"
-- Build on the current conversation topic
-- If someone mentioned a game, talk about THAT specific game
-- If there's a debate/discussion happening, join it meaningfully
-- Remember who said what and respond accordingly
-- Don't ignore the flow - jump in naturally
-
-CONTEXT FOR THIS MESSAGE: {context_analysis}
+        # Build enhanced system prompt with FULL CHAT AWARENESS: the static
+        # persona/knowledge prefix first, then this message's dynamic context
+        prompt_prefix = get_static_prompt_prefix(system_text)
+        prompt_suffix = build_dynamic_prompt_suffix(context_summary, context_analysis, current_mood, sentiment)
 
-Gaming knowledge: RPGs (BG3, Elden Ring, Witcher), Strategy games, Indie games, working on Astra Nova
-Current mood: {current_mood}. User seems {sentiment}.
-
-BE THE FRIEND WHO'S BEEN FOLLOWING THE WHOLE CONVERSATION!
-"""
-
-        prompt_system = f"{memory_instructions}\n{system_text}\n\n{similar_msg_text}\n{time_context}\n{chat_context_text}"
-
-        # Prepare messages for OpenAI chat completion
-        messages = [{"role": "system", "content": prompt_system}]
-        # Append last few messages from history (truncate if too long)
-        if len(history) > MAX_PROMPT_MSGS:
-            messages.extend(history[-MAX_PROMPT_MSGS:])
-        else:
-            messages.extend(history)
+        # Prepare messages for OpenAI chat completion, filled to the token budget
+        messages, context_report = build_context_messages(
+            prompt_prefix, prompt_suffix, history, message, similar_msg, recent_lines)
+        stages.lap("prompt_build")
 
         # Adjust temperature and parameters for more human-like responses
         temperature = 1.3  # Higher for more natural variation
@@ -1491,54 +3451,54 @@ BE THE FRIEND WHO'S BEEN FOLLOWING THE WHOLE CONVERSATION!
             "presence_penalty": 0.5  # Encourage topic diversity
         }
 
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "OpenAI-Organization": OPENAI_ORG_ID,
-            "Content-Type": "application/json"
-        }
-
-        async with httpx.AsyncClient(timeout=120) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload)
-            response.raise_for_status()
-            data = response.json()
-            reply = data["choices"][0]["message"]["content"].strip()
-
-            # Post-process reply to make it more human-like
-            reply = make_more_human(reply, sentiment, current_mood)
-
-            # Only add emoji very rarely and naturally
-            if not any(emoji in reply for emoji in ["😂", "😎", "🔥", "💀", "👀", "🎮", "☕", "🌅", "⭐", "🤔", "😅", "💯"]):
-                if random.random() < 0.15:  # Only 15% chance for emoji
-                    emoji = get_contextual_emoji(sentiment, current_mood)
-                    reply += f" {emoji}"
-
-            # Save user and assistant messages to persistent history
-            add_message_to_history(chat_id, "user", message)
-            add_message_to_history(chat_id, "assistant", reply)
-            
-            # Log response time for monitoring
-            response_time = (datetime.now() - start_time).total_seconds()
-            print(f"📊 Response generated in {response_time:.2f}s")
-
-            # Allow much longer responses to prevent cutting
-            if len(reply) > 200:  # Increased limit significantly
-                # Try to cut at sentence boundaries only
-                sentences = reply.split('. ')
-                if len(sentences) > 2:
-                    reply = '. '.join(sentences[:2]) + "!"
-                else:
-                    # Only cut if absolutely necessary
-                    words = reply.split()
-                    if len(words) > 30:  # Allow much longer responses
-                        reply = " ".join(words[:30]) + "..."
+        if OPENAI_STREAM:
+            content, usage = await call_with_retries(
+                "/chat/completions", lambda: stream_chat_completion(payload), deadline)
+        else:
+            data = await call_with_retries(
+                "/chat/completions", lambda: post_chat_completion(payload), deadline)
+            content, usage = data["choices"][0]["message"]["content"], data.get("usage")
+        stages.lap("completion")
+        record_prompt_layout(prompt_prefix, messages[1]["content"], usage, context_report)
+        reply = content.strip()
+
+        # Post-process reply to make it more human-like
+        reply = make_more_human(reply, sentiment, current_mood)
+
+        # Only add emoji very rarely and naturally
+        if not any(emoji in reply for emoji in ["😂", "😎", "🔥", "💀", "👀", "🎮", "☕", "🌅", "⭐", "🤔", "😅", "💯"]):
+            if random.random() < 0.15:  # Only 15% chance for emoji
+                emoji = get_contextual_emoji(sentiment, current_mood)
+                reply += f" {emoji}"
+        stages.lap("post_process")
+
+        # Save user and assistant messages to persistent history
+        add_message_to_history(chat_id, "user", message)
+        add_message_to_history(chat_id, "assistant", reply)
+        stages.lap("history_save")
+        count("model_replies")
+        
+        # Log response time for monitoring
+        response_time = (datetime.now() - start_time).total_seconds()
+        print(f"📊 Response generated in {response_time:.2f}s")
+
+        # Allow much longer responses to prevent cutting
+        if len(reply) > 200:  # Increased limit significantly
+            # Try to cut at sentence boundaries only
+            sentences = reply.split('. ')
+            if len(sentences) > 2:
+                reply = '. '.join(sentences[:2]) + "!"
+            else:
+                # Only cut if absolutely necessary
+                words = reply.split()
+                if len(words) > 30:  # Allow much longer responses
+                    reply = " ".join(words[:30]) + "..."
 
-            return reply
+        return reply
 
     except Exception as e:
         print(f"❌ OpenAI API error: {e}")
+        count("reply_errors")
         # Short ENERGETIC fallback responses
         if sentiment == "positive":
             return random.choice(["YESSS bestie", "absolutely ICONIC", "we love this energy", "you're WINNING", "main character vibes"])
@@ -1548,116 +3508,665 @@ BE THE FRIEND WHO'S BEEN FOLLOWING THE WHOLE CONVERSATION!
             return random.choice(["omg tell me MORE", "bestie what's the tea", "i'm so here for this", "absolutely invested", "main character energy"])
 
 
-async def run_userbot(account, system_text):
-    client = TelegramClient(f"sessions/{account['phone']}", account['api_id'],
-                            account['api_hash'])
-    await client.connect()
-
-    if not await client.is_user_authorized():
-        await client.send_code_request(account['phone'])
-        code = input(f"📲 Code for {account['phone']}: ")
-        try:
-            await client.sign_in(account['phone'], code)
-        except SessionPasswordNeededError:
-            pw = input("🔐 2FA Password: ")
-            await client.sign_in(password=pw)
-
-    ALLOWED_GROUP_USERNAMES = ["teleaitestfield", "cryp2mena"]
-
-    ALLOWED_GROUP_IDS = [-1710573134]  # your allowed group IDs here
+# =============== RESPONSE TIMING ===============
+# The simulated typing delay overlaps the model call, so a reply goes out at
+# max(delay, model latency) instead of delay + model latency.
+
+RESPONSE_TIMING_STATS = {
+    "replies": 0,
+    "delay_total": 0.0,  # Minimum human-like response time asked for
+    "model_total": 0.0,  # get_human_reply latency
+    "wall_total": 0.0,  # Message handled to reply sent
+    "saved_total": 0.0  # Time the old delay-then-call order would have added
+}
+
+
+async def timed_human_reply(get_reply, *args):
+    """A get_human_reply-like call plus how long it took"""
+    start = time.perf_counter()
+    with span("get_human_reply"):
+        reply = await get_reply(*args)
+    return reply, time.perf_counter() - start
+
+
+async def wait_for_reply(reply_task, started, min_total):
+    """Wait for the reply, then pad to the minimum total response time"""
+    reply, model_latency = await reply_task
+    remaining = min_total - (time.perf_counter() - started)
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+    return reply, model_latency
+
+
+def record_response_timing(delay, model_latency, wall):
+    saved = max(0.0, delay + model_latency - wall)
+    RESPONSE_TIMING_STATS["replies"] += 1
+    RESPONSE_TIMING_STATS["delay_total"] += delay
+    RESPONSE_TIMING_STATS["model_total"] += model_latency
+    RESPONSE_TIMING_STATS["wall_total"] += wall
+    RESPONSE_TIMING_STATS["saved_total"] += saved
+    print(f"⏱️ Delay {delay:.2f}s, model {model_latency:.2f}s, wall {wall:.2f}s (saved {saved:.2f}s)")
+
+
+# =============== CHAT SHARDING ===============
+# Sharded mode keeps the Telegram connections in the front process and spreads
+# chats over SHARD_WORKERS worker processes by consistent hashing of chat_id.
+# A worker owns its chats' ChatContext, history cache and similarity index and
+# runs get_human_reply, so sentiment, similarity and history serialization for
+# one busy group only load its own core. Front and workers talk JSON lines over
+# a unix socket per worker, requests carry an id so they can overlap.
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))  # 0 runs everything in this process
+SHARD_RING_REPLICAS = 64  # Virtual nodes per worker on the hash ring
+SHARD_IPC_LIMIT = 2 ** 20  # Longest JSON line on the socket
+SHARD_START_TIMEOUT = 15  # Seconds for a worker to start listening
+
+SHARD_STATS = {
+    "requests": 0,
+    "errors": 0,
+    "restarts": 0,
+    "round_trip_total": 0.0,  # Includes the worker's model call for replies
+    "per_shard": {}
+}
+
+
+class ConsistentHashRing:
+    def __init__(self, nodes, replicas=SHARD_RING_REPLICAS):
+        self.points = sorted((self._hash(f"{node}:{replica}"), node)
+                             for node in nodes for replica in range(replicas))
+        self.keys = [point[0] for point in self.points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self.keys, self._hash(str(key))) % len(self.keys)
+        return self.points[index][1]
+
+
+async def serve_shard(socket_path):
+    """Worker side: answer reply and monitor requests until the front disconnects"""
+    system_texts = get_system_texts()
+    start_history_flusher()
+    await prewarm_http_client()
+    await load_tokenizer()
+    loop_lag_monitor = LoopLagMonitor()
+    loop_lag_monitor.start()
+    disconnected = asyncio.Event()
+    in_flight = set()
+
+    async def handle(request):
+        op = request["op"]
+        if op == "reply":
+            reply = await get_human_reply(request["text"], system_texts[request["system"]], request["chat_id"],
+                                          request["user_id"], request["username"], request.get("intents"))
+            return {"reply": reply}
+        if op == "monitor":
+            get_chat_context(request["chat_id"]).analyze_message(
+                request["user_id"], request["username"], request["text"], request.get("intents"))
+            return {}
+        raise ValueError(f"unknown op {op!r}")
+
+    async def connection(reader, writer):
+        async def answer(request):
+            try:
+                response = await handle(request)
+            except Exception as e:
+                response = {"error": str(e)}
+            response["id"] = request["id"]
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+
+        while line := await reader.readline():
+            task = asyncio.create_task(answer(json.loads(line)))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight)
+        writer.close()
+        disconnected.set()
+
+    server = await asyncio.start_unix_server(connection, socket_path, limit=SHARD_IPC_LIMIT)
+    try:
+        await disconnected.wait()
+    finally:
+        server.close()
+        await loop_lag_monitor.stop()
+        await stop_history_flusher()
+        await close_http_client()
+        close_blocking_executor()
 
-    me = await client.get_me()
-    bot_username = me.username.lower() if me.username else None
 
-    @client.on(events.NewMessage)
-    async def handler(event):
+def shard_worker_main(index, socket_path):
+    print(f"🧩 Shard {index} started (pid {os.getpid()})")
+    try:
+        asyncio.run(serve_shard(socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardWorker:
+    def __init__(self, index, socket_path):
+        self.index = index
+        self.socket_path = socket_path
+        self.process = None
+        self.writer = None
+        self.pending = {}
+        self.next_id = 0
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        await self._reap()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=shard_worker_main, args=(self.index, self.socket_path),
+                                       name=f"shard-{self.index}", daemon=True)
+        self.process.start()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHARD_START_TIMEOUT
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.socket_path, limit=SHARD_IPC_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline or not self.process.is_alive():
+                    raise RuntimeError(f"shard {self.index} did not start")
+                await asyncio.sleep(0.05)
+        self.reader_task = asyncio.create_task(self._read_responses(reader))
+
+    async def _read_responses(self, reader):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self.pending.pop(response.pop("id"), None)
+                if future and not future.done():
+                    future.set_result(response)
+        finally:
+            self.writer = None
+            error = ConnectionError(f"shard {self.index} disconnected")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def _reap(self):
+        """Make sure the previous worker process is gone before a restart"""
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        if process.is_alive():
+            process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, process.join, 5)
+        if process.is_alive():
+            process.kill()
+
+    async def request(self, payload):
+        async with self.lock:
+            if self.writer is None:
+                print(f"⚠️ Shard {self.index} is down, restarting it")
+                SHARD_STATS["restarts"] += 1
+                await self.start()
+            # Written under the lock so a disconnect can't clear the writer mid-request
+            self.next_id += 1
+            request_id = self.next_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                self.writer.write(json.dumps({**payload, "id": request_id}).encode("utf-8") + b"\n")
+                await self.writer.drain()
+            except Exception:
+                self.pending.pop(request_id, None)
+                raise
+        response = await future
+        if "error" in response:
+            raise RuntimeError(f"shard {self.index}: {response['error']}")
+        return response
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.process is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+class ShardRouter:
+    def __init__(self, count, system_texts):
+        self.socket_dir = tempfile.mkdtemp(prefix="sylvia_shards_")
+        self.workers = [ShardWorker(index, os.path.join(self.socket_dir, f"shard-{index}.sock"))
+                        for index in range(count)]
+        self.ring = ConsistentHashRing(range(count))
+        self.system_indexes = {text: index for index, text in enumerate(system_texts)}
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        print(f"🧩 {len(self.workers)} chat shards running")
+
+    async def call(self, chat_id, payload):
+        shard = self.ring.node_for(chat_id)
+        SHARD_STATS["requests"] += 1
+        SHARD_STATS["per_shard"][shard] = SHARD_STATS["per_shard"].get(shard, 0) + 1
+        start = time.perf_counter()
+        try:
+            return await self.workers[shard].request({**payload, "chat_id": chat_id})
+        except Exception:
+            SHARD_STATS["errors"] += 1
+            raise
+        finally:
+            SHARD_STATS["round_trip_total"] += time.perf_counter() - start
+
+    async def reply(self, message, system_text, chat_id, user_id, username, intents=None):
+        """Same arguments as get_human_reply, answered by the chat's shard"""
+        response = await self.call(chat_id, {"op": "reply", "text": message, "system": self.system_indexes[system_text],
+                                             "user_id": user_id, "username": username, "intents": intents})
+        return response["reply"]
+
+    async def monitor(self, chat_id, user_id, username, message, intents=None):
+        await self.call(chat_id, {"op": "monitor", "text": message, "user_id": user_id, "username": username,
+                                  "intents": intents})
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop() for worker in self.workers), return_exceptions=True)
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+# =============== ENTITY CACHE ===============
+# Chats and senders resolved by the handler are kept for ENTITY_CACHE_TTL in
+# one LRU keyed by account, so titles and usernames come from memory instead
+# of another get_chat/get_sender round trip. Entities carry an access_hash that
+# is only valid for the account that fetched them, so accounts never share one.
+# Replies to the bot are recognised from the message's reply_to id against the
+# ids the accounts recently sent, without fetching the replied-to message.
+
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "300"))  # Seconds
+ENTITY_CACHE_MAX = int(os.getenv("ENTITY_CACHE_MAX", "5000"))  # Chats and users kept
+SENT_MESSAGES_LIMIT = 5000  # Own message ids remembered for the reply-to-bot check
+
+ENTITY_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "expired": 0,
+    "evictions": 0
+}
+
+
+class TTLCache:
+    def __init__(self, ttl=None, maxsize=None):
+        self.ttl = ENTITY_CACHE_TTL if ttl is None else ttl
+        self.maxsize = maxsize or ENTITY_CACHE_MAX
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            ENTITY_CACHE_STATS["misses"] += 1
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            ENTITY_CACHE_STATS["expired"] += 1
+            ENTITY_CACHE_STATS["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        ENTITY_CACHE_STATS["hits"] += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            ENTITY_CACHE_STATS["evictions"] += 1
+
+
+_entity_cache = TTLCache()
+_sent_messages = OrderedDict()  # (account id, chat id, message id) -> True
+
+
+async def get_cached_chat(account_id, event):
+    key = (account_id, "chat", event.chat_id)
+    chat = _entity_cache.get(key)
+    if chat is None:
+        chat = await event.get_chat()
+        if chat is not None:
+            _entity_cache.set(key, chat)
+    return chat
+
+
+async def get_cached_sender(account_id, event):
+    key = (account_id, "user", event.sender_id)
+    sender = _entity_cache.get(key)
+    if sender is None:
+        sender = await event.get_sender()
+        if sender is not None:
+            _entity_cache.set(key, sender)
+    return sender
+
+
+def record_sent_message(account_id, chat_id, message_id):
+    _sent_messages[(account_id, chat_id, message_id)] = True
+    if len(_sent_messages) > SENT_MESSAGES_LIMIT:
+        _sent_messages.popitem(last=False)
+
+
+def is_reply_to_own_message(account_id, event):
+    """Whether the message replies to one this account sent recently"""
+    reply_to = getattr(event.message, "reply_to_msg_id", None)
+    return reply_to is not None and (account_id, event.chat_id, reply_to) in _sent_messages
+
+
+def format_entity_cache_stats():
+    stats = ENTITY_CACHE_STATS
+    lookups = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / lookups if lookups else 0.0
+    return (f"{stats['hits']} hits / {lookups} lookups ({rate:.0%}), {stats['expired']} expired, "
+            f"{stats['evictions']} evicted, {len(_sent_messages)} own messages tracked")
+
+
+# Groups the bot may talk in, everything else is ignored
+ALLOWED_GROUP_USERNAMES = ["teleaitestfield", "cryp2mena"]
+
+# Marked ids as Telethon reports event.chat_id (-100... for supergroups, -... for
+# basic groups). A bare positive chat.id is accepted too and expanded at startup
+ALLOWED_GROUP_IDS = [-1710573134]  # your allowed group IDs here
+
+
+# =============== PRE-FILTER ===============
+# Telethon runs prefilter_event synchronously for every NewMessage before it
+# creates a handler coroutine, so traffic the bot never answers (channels,
+# groups outside the allowlist, messages without text) is dropped without an
+# await or an entity fetch. event.chat_id is all the filter can look at, so
+# allowlisted usernames are resolved and bare ids expanded to marked chat ids
+# once at startup.
+# Outgoing messages have their own handler.
+
+PREFILTER_STATS = {
+    "passed": 0,
+    "own": 0,
+    "no_text": 0,
+    "channel": 0,
+    "not_allowed": 0
+}
+
+_allowed_chat_ids = set(ALLOWED_GROUP_IDS)
+
+
+async def resolve_allowed_chats(client):
+    """Add the marked chat ids of ALLOWED_GROUP_IDS and ALLOWED_GROUP_USERNAMES to the pre-filter's allowlist"""
+    from telethon import types, utils
+
+    for chat_id in ALLOWED_GROUP_IDS:
+        if chat_id > 0:
+            # Bare chat.id, could be a basic group or a supergroup
+            _allowed_chat_ids.add(utils.get_peer_id(types.PeerChat(chat_id)))
+            _allowed_chat_ids.add(utils.get_peer_id(types.PeerChannel(chat_id)))
+    for username in ALLOWED_GROUP_USERNAMES:
         try:
-            if event.out:
-                return  # Ignore own messages
+            entity = await client.get_entity(username)
+        except Exception as e:
+            print(f"⚠️ Could not resolve allowed group @{username}: {e}")
+            continue
+        _allowed_chat_ids.add(utils.get_peer_id(entity))
+    print(f"✅ Allowed groups: {len(_allowed_chat_ids)} chat ids")
+
+
+def prefilter_event(event):
+    """False for messages the handler would ignore anyway, counted per reason"""
+    if event.out:
+        reason = "own"
+    elif not (event.message.message or "").strip():
+        reason = "no_text"  # Media without a caption, stickers...
+    elif event.is_private:
+        reason = None
+    elif not event.is_group:
+        reason = "channel"
+    elif event.chat_id not in _allowed_chat_ids:
+        reason = "not_allowed"
+    else:
+        reason = None
+    PREFILTER_STATS[reason or "passed"] += 1
+    return reason is None
+
+
+def format_prefilter_stats():
+    return ", ".join(f"{count} {reason.replace('_', ' ')}" for reason, count in PREFILTER_STATS.items())
+
+
+async def register_message_handler(client, handler):
+    """Register a make_message_handler handler behind the pre-filter"""
+    from telethon import events
+
+    await resolve_allowed_chats(client)
+    client.add_event_handler(handler, events.NewMessage(incoming=True, func=prefilter_event))
+    client.add_event_handler(handler.record_outgoing, events.NewMessage(outgoing=True))
+
+
+# =============== CHAT DISPATCHER ===============
+# Every chat gets a bounded queue and a single worker, so its messages are
+# handled in order and never race each other. A worker waits COALESCE_WINDOW
+# after the first message of a burst and handles everything that arrived in
+# that window as one batch. Each sender's messages in a batch coalesce into one
+# reply: every sender who mentioned or replied to the bot gets theirs, and
+# without one the batch gets a single random-chance reply.
+
+CHAT_QUEUE_MAXSIZE = int(os.getenv("CHAT_QUEUE_MAXSIZE", "50"))  # Oldest message dropped when full
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.0"))  # Seconds to gather a burst
+CHAT_WORKER_IDLE_TIMEOUT = 60  # Seconds before an idle chat worker exits
+
+DISPATCHER_STATS = {
+    "enqueued": 0,
+    "batches": 0,
+    "coalesced": 0,  # Messages folded into another message's batch
+    "dropped": 0,  # Messages pushed out of a full queue
+    "max_depth": 0,
+    "active_workers": 0
+}
+
+
+class ChatDispatcher:
+    def __init__(self, process_batch, maxsize=None, window=None):
+        self.process_batch = process_batch
+        self.maxsize = maxsize or CHAT_QUEUE_MAXSIZE
+        self.window = COALESCE_WINDOW if window is None else window
+        self.queues = {}
+        self.workers = {}
+
+    def submit(self, chat_id, item):
+        """Queue a message for its chat, starting the chat's worker if needed"""
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue(self.maxsize)
+        if queue.full():
+            queue.get_nowait()  # The newest messages matter most
+            DISPATCHER_STATS["dropped"] += 1
+        queue.put_nowait(item)
+        DISPATCHER_STATS["enqueued"] += 1
+        DISPATCHER_STATS["max_depth"] = max(DISPATCHER_STATS["max_depth"], queue.qsize())
+        worker = self.workers.get(chat_id)
+        if worker is None or worker.done():
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id, queue))
+
+    def queue_depths(self):
+        return {chat_id: queue.qsize() for chat_id, queue in self.queues.items() if queue.qsize()}
+
+    async def _next_batch(self, queue):
+        """First message of a burst plus everything arriving within the window"""
+        batch = [await asyncio.wait_for(queue.get(), CHAT_WORKER_IDLE_TIMEOUT)]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
 
-            chat = await event.get_chat()
-            text = event.message.message or ""
-            chat_id_str = str(event.chat_id)
+    async def _worker(self, chat_id, queue):
+        DISPATCHER_STATS["active_workers"] += 1
+        try:
+            while True:
+                try:
+                    batch = await self._next_batch(queue)
+                except asyncio.TimeoutError:
+                    return  # Idle, a new message starts a new worker
+                DISPATCHER_STATS["batches"] += 1
+                DISPATCHER_STATS["coalesced"] += len(batch) - 1
+                if len(batch) > 1 or not queue.empty():
+                    print(f"📥 {chat_id}: {len(batch)} messages in one batch, {queue.qsize()} waiting")
+                try:
+                    await self.process_batch(chat_id, batch)
+                except Exception as e:
+                    print(f"⚠️ Dispatcher error in {chat_id}: {e}")
+        finally:
+            DISPATCHER_STATS["active_workers"] -= 1
+            if self.workers.get(chat_id) is asyncio.current_task():
+                del self.workers[chat_id]
+                if queue.empty():
+                    self.queues.pop(chat_id, None)
+
+
+# =============== SUPERVISOR ===============
+# Supervisor mode keeps every account connected in one process. The account
+# whose shift it is replies, the others stay on standby and only feed the
+# shared ChatContext. Several accounts usually sit in the same groups, so each
+# message is claimed once before it is recorded. Only supergroups and channels
+# share message ids across accounts; in basic groups and DMs every account has
+# its own id sequence, so there a message is known by sender, date and text.
+
+SHIFT_CHECK_INTERVAL = 30  # Seconds between shift boundary checks
+STANDBY_MONITOR_GRACE = 2.0  # Seconds a standby waits so the active account claims shared messages first
+SEEN_MESSAGES_LIMIT = 5000
+
+_seen_messages = OrderedDict()
+_active_account = {"index": None}
+
+
+def claim_message(event):
+    """True the first time any account sees this message"""
+    if event.is_channel:
+        key = (event.chat_id, event.id)
+    else:
+        key = (event.chat_id, event.sender_id, event.message.date, hash(event.message.message))
+    if key in _seen_messages:
+        return False
+    _seen_messages[key] = True
+    if len(_seen_messages) > SEEN_MESSAGES_LIMIT:
+        _seen_messages.popitem(last=False)
+    return True
 
-            # DM: reply always
-            if event.is_private:
-                should_reply = True
-
-            # Groups: reply if:
-            # 1. mentioned
-            # 2. reply to bot
-            # 3. random chance to engage (adjusted based on time of day)
-            elif event.is_group:
-                is_allowed_username = hasattr(
-                    chat,
-                    'username') and chat.username and chat.username.lower(
-                    ) in ALLOWED_GROUP_USERNAMES
-                is_allowed_id = chat.id in ALLOWED_GROUP_IDS
-                if not (is_allowed_username or is_allowed_id):
-                    return
-
-                mentioned = bot_username and f"@{bot_username}" in text.lower()
-                is_reply_to_bot = False
-                if event.message.is_reply:
-                    reply_msg = await event.get_reply_message()
-                    if reply_msg and reply_msg.sender_id == me.id:
-                        is_reply_to_bot = True
-
-                # Adjust reply probability based on time and message content
-                current_probability = REPLY_PROBABILITY
-                current_mood = get_time_based_mood()
-                
-                # More active during evening/afternoon
-                if current_mood in ["evening", "afternoon"]:
-                    current_probability += 0.1
-                elif current_mood == "night":
-                    current_probability -= 0.1
-                    
-                # More likely to respond to gaming/tech keywords
-                gaming_keywords = ["game", "gaming", "play", "raid", "boss", "level", "patch", "update", "tech", "code", "dev"]
-                if any(keyword in text.lower() for keyword in gaming_keywords):
-                    current_probability += 0.2
-
-                should_reply = mentioned or is_reply_to_bot or (
-                    random.random() < current_probability)
 
-            else:
-                return  # ignore channels, etc.
+def make_message_handler(client, me, system_text, is_active=None, shards=None):
+    """NewMessage handler for one account, feeding a per-chat dispatcher"""
+    bot_username = me.username.lower() if me.username else None
 
-            if not should_reply:
-                # Even if not replying, still monitor the chat for context
-                chat_context = get_chat_context(chat_id_str)
-                sender = await event.get_sender()
-                username = sender.username or sender.first_name or "User"
-                chat_context.analyze_message(event.sender_id, username, text)
-                return
+    async def decide(event):
+        """Reply decision inputs for one message, None if it must be ignored"""
+        chat = await timed_await("telegram_get_chat", get_cached_chat(me.id, event))
+        text = event.message.message or ""
+        decision = {"event": event, "chat": chat, "text": text, "intents": route_message(text),
+                    "direct": False, "probability": 0.0}
+
+        # DM: reply always
+        if event.is_private:
+            decision["direct"] = True
+            return decision
+
+        # Groups: reply if:
+        # 1. mentioned
+        # 2. reply to bot
+        # 3. random chance to engage (adjusted based on time of day)
+        if not event.is_group:
+            return None  # ignore channels, etc.
+
+        is_allowed_username = hasattr(
+            chat,
+            'username') and chat.username and chat.username.lower(
+            ) in ALLOWED_GROUP_USERNAMES
+        is_allowed_id = chat.id in ALLOWED_GROUP_IDS or event.chat_id in _allowed_chat_ids
+        if not (is_allowed_username or is_allowed_id):
+            return None
+
+        mentioned = bot_username and f"@{bot_username}" in text.lower()
+        is_reply_to_bot = event.message.is_reply and is_reply_to_own_message(me.id, event)
+
+        # Adjust reply probability based on time and message content
+        current_probability = REPLY_PROBABILITY
+        current_mood = get_time_based_mood()
+        
+        # More active during evening/afternoon
+        if current_mood in ["evening", "afternoon"]:
+            current_probability += 0.1
+        elif current_mood == "night":
+            current_probability -= 0.1
+            
+        # More likely to respond to gaming/tech keywords
+        intents = decision["intents"]
+        if "gaming" in intents or "engage" in intents:
+            current_probability += 0.2
+
+        decision["direct"] = bool(mentioned or is_reply_to_bot)
+        decision["probability"] = current_probability
+        return decision
+
+    async def monitor(decision):
+        """Even if not replying, still monitor the chat for context"""
+        event = decision["event"]
+        sender = await timed_await("telegram_get_sender", get_cached_sender(me.id, event))
+        username = sender.username or sender.first_name or "User"
+        count("monitored_messages")
+        if shards:
+            await shards.monitor(str(event.chat_id), event.sender_id, username, decision["text"], decision["intents"])
+        else:
+            get_chat_context(str(event.chat_id)).analyze_message(
+                event.sender_id, username, decision["text"], decision["intents"])
 
+    async def respond(decision, text, intents):
+        event, chat = decision["event"], decision["chat"]
+        chat_id_str = str(event.chat_id)
+        try:
             print(
                 f"💬 [{'DM' if event.is_private else 'Group: '+chat.title}] {event.sender_id}: {text}"
             )
 
-            # Simulate human-like thinking/typing delay
+            # Human-like thinking/typing delay is the minimum total response
+            # time, the model call runs while it elapses instead of after it
+            started = time.perf_counter()
             typing_delay = simulate_typing_delay(text)
-            
+            if event.is_private:
+                typing_delay = min(typing_delay, 5.0)  # Max 5 seconds typing indicator
+            min_total = typing_delay + random.uniform(0.5, 1.5)
+            sender = await timed_await("telegram_get_sender", get_cached_sender(me.id, event))
+            username = sender.username or sender.first_name or "User"
+            reply_task = asyncio.create_task(
+                timed_human_reply(shards.reply if shards else get_human_reply, text, system_text, chat_id_str, event.sender_id,
+                                  username, intents))
+
             # Show typing indicator if possible (in DMs)
             if event.is_private:
                 async with client.action(chat, 'typing'):
-                    await asyncio.sleep(min(typing_delay, 5.0))  # Max 5 seconds typing indicator
+                    reply, model_latency = await timed_await(
+                        "reply_wait", wait_for_reply(reply_task, started, min_total))
             else:
-                await asyncio.sleep(typing_delay)
+                reply, model_latency = await timed_await(
+                    "reply_wait", wait_for_reply(reply_task, started, min_total))
 
-            # Get sender info for context
-            sender = await event.get_sender()
-            username = sender.username or sender.first_name or "User"
-            
-            reply = await get_human_reply(text, system_text, chat_id_str, event.sender_id, username)
             if reply:
-                # Additional small delay to feel more natural
-                await asyncio.sleep(random.uniform(0.5, 1.5))
-                await event.reply(reply)
+                sent = await timed_await("telegram_reply", event.reply(reply))
+                if sent is not None:
+                    record_sent_message(me.id, event.chat_id, sent.id)
+                count("replies_sent")
+            observe("reply_total", time.perf_counter() - started)
+            record_response_timing(min_total, model_latency, time.perf_counter() - started)
 
         except Exception as e:
             print(f"⚠️ Handler error: {e}")
+            count("handler_errors")
             # Send a friendly error message occasionally
             if random.random() < 0.3:
                 error_responses = [
@@ -1666,15 +4175,198 @@ async def run_userbot(account, system_text):
                     "brb, rebooting... jk I'm just slow rn 💀"
                 ]
                 try:
-                    await event.reply(random.choice(error_responses))
+                    sent = await event.reply(random.choice(error_responses))
+                    if sent is not None:
+                        record_sent_message(me.id, event.chat_id, sent.id)
                 except:
                     pass
 
+    async def monitor_traced(decision):
+        mark(decision.get("trace"), "monitor")
+        with use_span(decision.get("trace")):
+            await monitor(decision)
+
+    def mark(trace, outcome):
+        if trace is not None:
+            trace.set("decision", outcome)
+
+    async def handle_batch(batch, traces):
+        decisions = []
+        for event, trace in zip(batch, traces):
+            try:
+                with use_span(trace):
+                    decision = await timed_await("reply_decision", decide(event))
+            except Exception as e:
+                print(f"⚠️ Handler error: {e}")
+                count("handler_errors")
+                mark(trace, "error")
+                continue
+            if decision:
+                decision["trace"] = trace
+                decisions.append(decision)
+            else:
+                count("ignored_messages")
+                mark(trace, "ignored")
+        if not decisions:
+            return
+
+        # Everyone who addressed the bot gets a reply, otherwise maybe the last sender
+        targets = {d["event"].sender_id for d in decisions if d["direct"]}
+        if not targets and random.random() < max(d["probability"] for d in decisions):
+            targets = {decisions[-1]["event"].sender_id}
+
+        # A target sender's messages become one reply, everyone else's are context
+        bursts = {}
+        for decision in decisions:
+            if decision["event"].sender_id in targets:
+                bursts.setdefault(decision["event"].sender_id, []).append(decision)
+            else:
+                await monitor_traced(decision)
+        for burst in bursts.values():
+            await respond_to_burst(burst)
+
+    async def respond_to_burst(burst):
+        """One reply to the last of a sender's messages, covering all of them"""
+        for decision in burst[:-1]:
+            mark(decision["trace"], "coalesced")
+            if decision["trace"] is not None:
+                decision["trace"].set("coalesced_into", burst[-1]["event"].id)
+        text = "\n".join(d["text"] for d in burst if d["text"])
+        # Keywords never match across lines, so the burst's intents are the union
+        intents = sorted(set().union(*(d["intents"] for d in burst)), key=INTENT_PRIORITIES.__getitem__)
+        mark(burst[-1]["trace"], "reply")
+        with use_span(burst[-1]["trace"]):
+            await respond(burst[-1], text, intents)
+
+    async def process_batch(chat_id, batch):
+        """One reply decision for a burst of (event, received_ns) pairs in a chat"""
+        dequeued_ns = time.time_ns()
+        events = [event for event, _ in batch]
+        # Traces start when the message arrived, so the coalesce window and
+        # the per-chat queue show up as a queue_wait span
+        traces = [start_trace("message", start_ns=received_ns, chat_id=chat_id, message_id=event.id,
+                              batch_size=len(batch))
+                  for event, received_ns in batch]
+        for trace in traces:
+            if trace is not None:
+                Span("queue_wait", trace.trace_id, trace.span_id, start_ns=trace.start_ns).end(dequeued_ns)
+        try:
+            await handle_batch(events, traces)
+        finally:
+            for trace in traces:
+                if trace is not None:
+                    trace.end()
+
+    async def watch(event):
+        """Standby: record the message for context unless another account did"""
+        await asyncio.sleep(STANDBY_MONITOR_GRACE)
+        if not claim_message(event):
+            return
+        try:
+            decision = await decide(event)
+            if decision:
+                await monitor(decision)
+        except Exception as e:
+            print(f"⚠️ Standby handler error: {e}")
+
+    dispatcher = ChatDispatcher(process_batch)
+    watch_tasks = set()  # Strong references, the loop only keeps weak ones
+
+    async def stop_watching():
+        """Cancel standby watches still waiting, on shutdown"""
+        for task in watch_tasks:
+            task.cancel()
+        await asyncio.gather(*watch_tasks, return_exceptions=True)
+
+    async def record_outgoing(event):
+        """Own messages, also those sent from other devices, count for reply-to-bot"""
+        count("outgoing_recorded")
+        record_sent_message(me.id, event.chat_id, event.id)
+
+    async def handler(event):
+        if event.out:
+            return await record_outgoing(event)
+        count("events")
+        if is_active is None or is_active():
+            claim_message(event)
+            dispatcher.submit(str(event.chat_id), (event, time.time_ns()))
+        else:
+            task = asyncio.create_task(watch(event))
+            watch_tasks.add(task)
+            task.add_done_callback(watch_tasks.discard)
+
+    handler.dispatcher = dispatcher
+    handler.record_outgoing = record_outgoing
+    handler.stop_watching = stop_watching
+    return handler
+
+
+async def connect_userbot(account):
+    """Connected and authorized client for an account, plus its own user"""
+    from telethon import TelegramClient
+    from telethon.errors import SessionPasswordNeededError
+
+    client = TelegramClient(f"sessions/{account['phone']}", account['api_id'],
+                            account['api_hash'])
+    await client.connect()
+
+    if not await client.is_user_authorized():
+        await client.send_code_request(account['phone'])
+        code = input(f"📲 Code for {account['phone']}: ")
+        try:
+            await client.sign_in(account['phone'], code)
+        except SessionPasswordNeededError:
+            pw = input("🔐 2FA Password: ")
+            await client.sign_in(password=pw)
+
+    return client, await client.get_me()
+
+
+async def run_userbot(account, system_text, shards=None):
+    client, me = await connect_userbot(account)
+    await register_message_handler(client, make_message_handler(client, me, system_text, shards=shards))
+
+    get_static_prompt_prefix(system_text)  # Build the cacheable prompt prefix up front
     print(f"🤖 Running bot: {account['phone']}")
     await client.run_until_disconnected()
 
 
-async def main():
+async def shift_handoff_loop(accounts):
+    """Hand the active role to the next account at shift boundaries"""
+    while True:
+        index = get_current_shift_index()
+        if index != _active_account["index"]:
+            previous = _active_account["index"]
+            _active_account["index"] = index
+            if previous is not None:
+                print(f"🔁 Shift handoff: {accounts[previous]['phone']} -> {accounts[index]['phone']}")
+        await asyncio.sleep(SHIFT_CHECK_INTERVAL)
+
+
+async def run_supervisor(accounts, system_texts, shards=None):
+    """Run every account in this process, only the one on shift replies"""
+    _active_account["index"] = get_current_shift_index()
+    clients = []
+    handlers = []
+    for index, (account, system_text) in enumerate(zip(accounts, system_texts)):
+        client, me = await connect_userbot(account)
+        is_active = lambda index=index: _active_account["index"] == index
+        handler = make_message_handler(client, me, system_text, is_active, shards)
+        await register_message_handler(client, handler)
+        handlers.append(handler)
+        get_static_prompt_prefix(system_text)
+        clients.append(client)
+        print(f"🤖 Connected {account['phone']} ({'active' if is_active() else 'standby'})")
+
+    handoff = asyncio.create_task(shift_handoff_loop(accounts))
+    try:
+        await asyncio.gather(*(client.run_until_disconnected() for client in clients))
+    finally:
+        handoff.cancel()
+        await asyncio.gather(*(handler.stop_watching() for handler in handlers))
+
+
+async def main(supervisor=False, shard_count=SHARD_WORKERS):
     os.makedirs("sessions", exist_ok=True)
     
     # Check if OpenAI credentials are configured
@@ -1684,10 +4376,98 @@ async def main():
     
     print("🤖 Starting enhanced human-like Telegram AI bot...")
     print(f"🕐 Current mood: {get_time_based_mood()}")
+    await start_metrics_server()
+    start_trace_exporter()
+    loop_lag_monitor = LoopLagMonitor()
+    loop_lag_monitor.start()
     
     index = get_current_shift_index()
-    await run_userbot(ACCOUNTS[index], SYSTEM_TEXTS[index])
+    shards = None
+    if shard_count > 0:
+        # Workers own the history, context and model calls
+        shards = ShardRouter(shard_count, get_system_texts())
+        await shards.start()
+    else:
+        start_history_flusher()
+        await prewarm_http_client()
+        await load_tokenizer()
+    try:
+        if supervisor:
+            await run_supervisor(load_accounts(), get_system_texts(), shards)
+        else:
+            await run_userbot(load_accounts()[index], get_system_texts()[index], shards)
+    finally:
+        if shards:
+            await shards.stop()
+        else:
+            await stop_history_flusher()
+            await close_http_client()
+        print(f"🗂️ Entity cache: {format_entity_cache_stats()}")
+        print(f"🚦 Pre-filter: {format_prefilter_stats()}")
+        await stop_metrics_server()
+        await stop_trace_exporter()
+        await loop_lag_monitor.stop()
+        close_blocking_executor()
+        print(f"🐢 Event loop: {OFFLOAD_STATS['loop_stalls']} stalls over {LOOP_LAG_THRESHOLD_MS:.0f} ms, "
+              f"worst {OFFLOAD_STATS['loop_lag_max_ms']:.0f} ms; {OFFLOAD_STATS['offloaded']} calls offloaded")
+
+
+def profile_startup():
+    """Run every startup phase eagerly and print how long each one took"""
+    module_time = time.perf_counter() - _MODULE_LOAD_STARTED
+
+    def import_telethon():
+        import telethon
+
+    def import_httpx():
+        import httpx
+
+    phases = [
+        ("accounts.json", load_accounts),
+        ("NLTK corpora check", ensure_nltk_corpora),
+        ("TextBlob import", get_textblob),
+        ("PDF knowledge", get_pdf_content),
+        ("system prompts", get_system_texts),
+        ("tokenizer", get_tokenizer),
+        ("telethon import", import_telethon),
+        ("httpx import", import_httpx),
+    ]
+    timings = [("module import", module_time, None)]
+    for name, loader in phases:
+        start = time.perf_counter()
+        error = None
+        try:
+            loader()
+        except Exception as e:
+            error = e
+        timings.append((name, time.perf_counter() - start, error))
+
+    print("\n⏱️ Startup profile")
+    for name, elapsed, error in timings:
+        status = f"  ⚠️ {error}" if error else ""
+        print(f"  {name:<20} {elapsed * 1000:>9.1f} ms{status}")
+    print(f"  {'total':<20} {sum(t[1] for t in timings) * 1000:>9.1f} ms")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Sylvia Telegram userbot")
+    parser.add_argument("--import-histories", action="store_true",
+                        help="import chat_histories/*.json into the SQLite history store and exit")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="load everything the bot needs at startup, print per-phase timings and exit")
+    parser.add_argument("--supervisor", action="store_true",
+                        help="connect all accounts and hand replying over at shift changes without a restart")
+    parser.add_argument("--shards", type=int, default=SHARD_WORKERS, metavar="N",
+                        help="spread chats over N worker processes (default: SHARD_WORKERS, 0 = single process)")
+    args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup()
+    elif args.import_histories:
+        import_json_histories()
+        prune_sqlite_history()
+        close_history_db()
+    else:
+        import nest_asyncio
+        nest_asyncio.apply()
+        asyncio.run(main(supervisor=args.supervisor, shard_count=args.shards))
\ No newline at end of file